@@ -1,16 +1,33 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pathlib import Path
+from typing import Optional
 
 class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite+aiosqlite:///./gemini_budget.db"
+    # Unset: 5 + 0 for SQLite (one writer at a time), 20 + 20 for server databases
+    DB_POOL_SIZE: Optional[int] = None
+    DB_MAX_OVERFLOW: Optional[int] = None
+    DB_POOL_TIMEOUT: float = 5
     AUTH_EMAIL_HEADER: str = "X-Forwarded-Email"
     UPLOAD_DIR: Path = Path("backend/uploads")
     GOOGLE_GENAI_KEY: str = ""
+    # Gemini 3 or later lets the agent search transactions while producing structured
+    # output; older models still work, without the search tool
     GOOGLE_GENAI_MODEL: str = "gemini-3-flash-preview"
     GENAI_LIMIT_QUERY: int = 5
     DEV_MODE: bool = False
+    QUERY_COUNT_WARN: int = 10
     MAX_CATEGORY: int = 100
     GEMINI_RPM: int = 20
+    GEMINI_MAX_CONCURRENCY: int = 4
+    # Documents rasterized concurrently by background processing
+    RENDER_CONCURRENCY: int = 2
+    # Ceiling on the resolution PDF pages are rasterized at. Pages are also scaled so
+    # their longest edge fits MAX_IMAGE_EDGE, which at the default 1536 px already
+    # limits Letter and A4 pages to ~130-140 dpi; raise both for sharper pages.
+    PDF_DPI: int = 150
+    # Longest edge, in pixels, of page images sent to Gemini
+    MAX_IMAGE_EDGE: int = 1536
     CORS_ORIGINS: list[str] = ["*"]
     
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
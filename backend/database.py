@@ -1,13 +1,217 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 from .config import settings
 
-engine = create_async_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
+# Applied to every new SQLite connection: WAL + NORMAL sync avoid an fsync per
+# write, and the larger page cache / mmap keep hot B-tree pages in memory.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+# query_cache_size is sized to hold every compiled statement the app issues,
+# so no request pays the SQL compile cost after warm-up.
+# The pool keeps a fixed set of warm connections: no overflow connections that
+# get opened and torn down per burst. A local SQLite file cannot drop a connection,
+# so ping/recycle are only enabled for server databases. Waiting for a free
+# connection is capped so an exhausted pool fails fast instead of queueing for 30s.
+_is_sqlite = make_url(settings.DATABASE_URL).get_backend_name() == "sqlite"
+engine = create_async_engine(
+    settings.DATABASE_URL,
+    query_cache_size=1200,
+    pool_size=settings.DB_POOL_SIZE if settings.DB_POOL_SIZE is not None else (5 if _is_sqlite else 20),
+    max_overflow=settings.DB_MAX_OVERFLOW if settings.DB_MAX_OVERFLOW is not None else (0 if _is_sqlite else 20),
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_pre_ping=not _is_sqlite,
+    pool_recycle=-1 if _is_sqlite else 1800,
+)
 SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession, expire_on_commit=False)
 
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+_query_counter: ContextVar[Optional[QueryCounter]] = ContextVar("query_counter", default=None)
+
+@contextmanager
+def count_queries():
+    """Counts the SQL statements executed in the current context (e.g. one request)."""
+    counter = QueryCounter()
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.count += 1
+
 class Base(DeclarativeBase):
     pass
 
+# Stored in PRAGMA user_version; bump it when a release changes the schema
+CURRENT_SCHEMA_VERSION = 8
+
+# SQL that fills NOT NULL columns added after a table was first created
+_ADDED_COLUMNS = {("merchant", "name_lower"): "lower(name)"}
+
+def dialect_insert(db: AsyncSession):
+    """The dialect's insert() construct, which adds on_conflict_do_update()."""
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+async def fetch_all_concurrently(db: AsyncSession, *statements) -> List[list]:
+    """
+    Runs independent SELECTs and returns each one's scalars. On server databases
+    every statement gets its own pooled connection, so the wait is the slowest query
+    rather than the sum; those reads don't see the caller's uncommitted changes.
+    SQLite serves a connection's statements one at a time, so there they run in
+    turn on `db`.
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        return [(await db.execute(statement)).scalars().all() for statement in statements]
+
+    async def fetch(statement):
+        async with AsyncSession(db.bind, expire_on_commit=False) as session:
+            return (await session.execute(statement)).scalars().all()
+
+    return list(await asyncio.gather(*(fetch(statement) for statement in statements)))
+
+def _drop_unique_index_duplicates(sync_conn, table):
+    """
+    Keeps only the newest row (highest rowid) per key of each unique index, so
+    unique indexes added by an upgrade can be created over older data. Partial
+    indexes only dedupe the rows they cover (pending proposals), and rows with a
+    NULL key column never conflict; both are left alone.
+    SQLite only: rows are ordered by rowid, and schema upgrades only run on SQLite.
+    """
+    if sync_conn.dialect.name != "sqlite":
+        raise NotImplementedError("unique index deduplication relies on SQLite's rowid")
+    preparer = sync_conn.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    for index in table.indexes:
+        if not index.unique:
+            continue
+        columns = [preparer.quote(col.name) for col in index.columns]
+        conditions = [f"{c} IS NOT NULL" for c in columns]
+        where = index.dialect_options["sqlite"].get("where")
+        if where is not None:
+            conditions.append(str(where.compile(sync_conn, compile_kwargs={"literal_binds": True})))
+        covered = " AND ".join(conditions)
+        result = sync_conn.execute(text(
+            f"DELETE FROM {name} WHERE {covered} "
+            f"AND rowid NOT IN (SELECT max(rowid) FROM {name} WHERE {covered} GROUP BY {', '.join(columns)})"
+        ))
+        if result.rowcount:
+            print(f"Warning: schema upgrade deleted {result.rowcount} duplicate rows from {table.name} (unique index {index.name})")
+
+def _upgrade_existing_tables(sync_conn):
+    """
+    Recreates tables created by older releases whose columns or server defaults
+    differ from the models (SQLite cannot alter a column in place), copying rows
+    across, and brings the indexes of the rest in line with the models.
+    """
+    inspector = inspect(sync_conn)
+    preparer = sync_conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"]: c for c in inspector.get_columns(table.name)}
+        if all(
+            col.name in existing and (col.server_default is None or existing[col.name]["default"] is not None)
+            for col in table.columns
+        ):
+            # create_all skips existing tables entirely, including their new indexes
+            model_indexes = {index.name for index in table.indexes}
+            for index in inspector.get_indexes(table.name):
+                if index["name"] not in model_indexes:
+                    sync_conn.execute(text(f"DROP INDEX {preparer.quote(index['name'])}"))
+            _drop_unique_index_duplicates(sync_conn, table)
+            for index in table.indexes:
+                index.create(sync_conn, checkfirst=True)
+            continue
+
+        print(f"Rebuilding table {table.name} for schema version {CURRENT_SCHEMA_VERSION}")
+        name, tmp_name = preparer.format_table(table), preparer.quote(f"_new_{table.name}")
+        ddl = str(CreateTable(table).compile(dialect=sync_conn.dialect))
+        sync_conn.execute(text(ddl.replace(f"CREATE TABLE {name} (", f"CREATE TABLE {tmp_name} (", 1)))
+
+        columns, sources = [], []
+        for col in table.columns:
+            if col.name in existing:
+                source = preparer.quote(col.name)
+            else:
+                source = _ADDED_COLUMNS.get((table.name, col.name))
+            if source:
+                columns.append(preparer.quote(col.name))
+                sources.append(source)
+        sync_conn.execute(text(
+            f"INSERT INTO {tmp_name} ({', '.join(columns)}) SELECT {', '.join(sources)} FROM {name}"
+        ))
+        sync_conn.execute(text(f"DROP TABLE {name}"))
+        sync_conn.execute(text(f"ALTER TABLE {tmp_name} RENAME TO {name}"))
+        _drop_unique_index_duplicates(sync_conn, table)
+        for index in table.indexes:
+            index.create(sync_conn)
+        if table.name == "merchant" and "name_lower" not in existing:
+            # SQLite's lower() only folds ASCII; match the models' str.lower()
+            rows = sync_conn.execute(text(f"SELECT id, name FROM {name}")).all()
+            if rows:
+                sync_conn.execute(
+                    text(f"UPDATE {name} SET name_lower = :name_lower WHERE id = :id"),
+                    [{"id": row.id, "name_lower": row.name.lower() if row.name else row.name} for row in rows],
+                )
+
+async def init_db():
+    """
+    Creates or upgrades the schema when PRAGMA user_version is behind
+    CURRENT_SCHEMA_VERSION. Hot restarts read one pragma and skip all DDL.
+    Models must be imported first so Base.metadata is populated.
+    """
+    if engine.dialect.name != "sqlite":
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        return
+
+    async with engine.connect() as conn:
+        # One write transaction for the whole upgrade; IMMEDIATE also makes
+        # concurrently starting workers wait here instead of racing the DDL.
+        await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        version = (await conn.exec_driver_sql("PRAGMA user_version")).scalar()
+        if version >= CURRENT_SCHEMA_VERSION:
+            await conn.rollback()
+            return
+        await conn.run_sync(_upgrade_existing_tables)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.exec_driver_sql(f"PRAGMA user_version = {CURRENT_SCHEMA_VERSION}")
+        await conn.commit()
+        print(f"Database schema upgraded from version {version} to {CURRENT_SCHEMA_VERSION}")
+
 async def get_db():
     async with SessionLocal() as session:
         yield session
@@ -1,15 +1,92 @@
-from fastapi import Header, Depends, HTTPException, status
+import asyncio
+import base64
+import binascii
+import json
+import weakref
+from datetime import datetime
+from cachetools import TTLCache
+from fastapi import Header, Depends, HTTPException, Response, status
+from sqlalchemy import DateTime, tuple_
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from .database import get_db
-from .models import User, Account, Category
+from .models import User, Account, Category, gen_uuid
 from .config import settings
-from typing import Optional
+from typing import NamedTuple, Optional
+
+# Maps X-Forwarded-Email -> user id so authenticated requests skip the email lookup
+_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+# Per-email locks serializing lazy registration, so concurrent first requests don't
+# insert the same user twice; an entry lives only while a request holds it
+_registration_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+DEFAULT_CATEGORIES = [
+    ("Food", "EXPENSE"),
+    ("Transportation", "EXPENSE"),
+    ("Housing", "EXPENSE"),
+    ("Entertainment", "EXPENSE"),
+    ("Utilities", "EXPENSE"),
+    ("Health", "EXPENSE"),
+    ("Salary", "INCOME"),
+    ("Others", "EXPENSE"),
+]
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Upper bound on one page, so a single list response never holds more rows than this
+MAX_PAGE_SIZE = 500
 
 class PaginationParams:
-    def __init__(self, skip: int = 0, limit: int = 100):
+    def __init__(self, skip: int = 0, limit: int = 100, cursor: Optional[str] = None):
         self.skip = skip
-        self.limit = limit
+        # Larger requests are clamped; the next-cursor header lets clients fetch the rest
+        self.limit = min(limit, MAX_PAGE_SIZE)
+        self.cursor = cursor
+
+def encode_cursor(*values) -> str:
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor: str, columns) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return [
+            datetime.fromisoformat(v) if isinstance(col.type, DateTime) else v
+            for col, v in zip(columns, values)
+        ]
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def paginate(query, pagination: PaginationParams, *columns, descending: bool = False):
+    """
+    Orders by `columns` (which must form a unique key, e.g. created_at + id) and
+    applies keyset pagination when a cursor is given, offset pagination otherwise.
+    """
+    query = query.order_by(*(c.desc() for c in columns) if descending else columns)
+    if pagination.cursor:
+        key = tuple_(*columns)
+        after = tuple(decode_cursor(pagination.cursor, columns))
+        query = query.where(key < after if descending else key > after)
+    else:
+        query = query.offset(pagination.skip)
+    return query.limit(pagination.limit)
+
+def set_next_cursor(response: Response, rows, pagination: PaginationParams, *columns):
+    """Exposes the cursor for the page after `rows` when the page is full."""
+    if rows and len(rows) == pagination.limit:
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(*(getattr(last, c.key) for c in columns))
+
+async def get_owned_or_404(db: AsyncSession, model, pk: str, user_id: str):
+    """
+    Loads a row by primary key (identity map first) and checks it belongs to the user.
+    Raises 404 when it is missing or owned by someone else.
+    """
+    obj = await db.get(model, pk)
+    if obj is None or obj.user_id != user_id:
+        raise HTTPException(status_code=404, detail=f"{model.__name__} not found")
+    return obj
 
 async def get_current_user(
     db: AsyncSession = Depends(get_db),
@@ -20,42 +97,64 @@ async def get_current_user(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"Missing {settings.AUTH_EMAIL_HEADER} header",
         )
-    
-    # Check if user exists, if not create them (lazy registration)
+
+    # Fast path: primary-key get, served from the identity map when possible
+    user_id = _user_cache.get(x_forwarded_email)
+    if user_id:
+        user = await db.get(User, user_id)
+        if user:
+            return user
+        # Stale entry (e.g. user removed), fall back to the lookup below
+        _user_cache.pop(x_forwarded_email, None)
+
+    # Existing users (e.g. after a cache expiry or restart) are looked up without locking
     result = await db.execute(select(User).where(User.email == x_forwarded_email))
     user = result.scalars().first()
-    
+
     if not user:
-        user = User(email=x_forwarded_email, full_name=x_forwarded_email.split("@")[0])
-        db.add(user)
-        await db.flush() # Flush to get user.id
-        
-        # Create default Petty Cash Account
-        petty_cash = Account(
-            user_id=user.id,
-            name="Petty Cash Account",
-            type="ASSET",
-            sub_type="CASH",
-            currency="USD",
-            description="Default account for miscellaneous cash expenses and bills without specified accounts."
-        )
-        db.add(petty_cash)
-        
-        # Create default categories
-        default_categories = [
-            ("Food", "EXPENSE"),
-            ("Transportation", "EXPENSE"),
-            ("Housing", "EXPENSE"),
-            ("Entertainment", "EXPENSE"),
-            ("Utilities", "EXPENSE"),
-            ("Health", "EXPENSE"),
-            ("Salary", "INCOME"),
-            ("Others", "EXPENSE"),
-        ]
-        for name, cat_type in default_categories:
-            db.add(Category(user_id=user.id, name=name, type=cat_type))
-            
-        await db.commit()
-        await db.refresh(user)
-    
+        async with _registration_locks.setdefault(x_forwarded_email, asyncio.Lock()):
+            # A concurrent request may have registered this user while we waited
+            user_id = _user_cache.get(x_forwarded_email)
+            user = await db.get(User, user_id) if user_id else None
+            if not user:
+                # Lazy registration. Assign the id client-side so children can reference it without a flush
+                user = User(id=gen_uuid(), email=x_forwarded_email, full_name=x_forwarded_email.split("@")[0])
+
+                # Create default Petty Cash Account
+                petty_cash = Account(
+                    user_id=user.id,
+                    name="Petty Cash Account",
+                    type="ASSET",
+                    sub_type="CASH",
+                    currency="USD",
+                    description="Default account for miscellaneous cash expenses and bills without specified accounts."
+                )
+
+                # Create default categories
+                categories = [
+                    Category(user_id=user.id, name=name, type=cat_type)
+                    for name, cat_type in DEFAULT_CATEGORIES
+                ]
+
+                # Single flush: one INSERT per table, categories sent as one batch
+                db.add_all([user, petty_cash, *categories])
+                await db.commit()
+            _user_cache[x_forwarded_email] = user.id
+    else:
+        _user_cache[x_forwarded_email] = user.id
+
     return user
+
+class AuthedSession(NamedTuple):
+    db: AsyncSession
+    user: User
+
+async def authed(
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user)
+) -> AuthedSession:
+    """
+    Session plus authenticated user as one dependency. get_db is shared with
+    get_current_user through FastAPI's per-request dependency cache.
+    """
+    return AuthedSession(db, user)
@@ -1,19 +1,60 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+import mimetypes
 import os
-from .database import engine, Base
+import posixpath
+from typing import Dict
+from .database import engine, count_queries, get_db, init_db
 from .routers import accounts, categories, transactions, documents, proposals, report, merchants
 from .config import settings
+from .services.document_processor import close_shared_resources
+from .dependencies import NEXT_CURSOR_HEADER
+
+# Serve built frontend
+static_dir = os.path.join(os.path.dirname(__file__), "static")
+# Files up to this size are held in memory; larger ones are streamed from disk
+STATIC_CACHE_MAX_BYTES = 256 * 1024
+
+def load_static_files(root: str):
+    """
+    Walks the built frontend once. Returns {url_path: (body, media_type)} for small
+    files and a set of url paths for large ones. /assets is skipped because it
+    is served by the StaticFiles mount.
+    """
+    cached, large = {}, set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root and "assets" in dirnames:
+            dirnames.remove("assets")
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            url_path = os.path.relpath(path, root).replace(os.sep, "/")
+            if os.path.getsize(path) > STATIC_CACHE_MAX_BYTES:
+                large.add(url_path)
+                continue
+            with open(path, "rb") as f:
+                media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                cached[url_path] = (f.read(), media_type)
+    return cached, large
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Initialize database tables
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Create or upgrade the schema only when PRAGMA user_version is behind
+    await init_db()
+    if engine.dialect.name == "sqlite":
+        async with engine.connect() as conn:
+            journal_mode = (await conn.execute(text("PRAGMA journal_mode"))).scalar()
+            print(f"SQLite journal_mode: {journal_mode}")
+
+    # Read the SPA shell and other top-level files once; the catch-all serves them from memory
+    app.state.static_files, app.state.large_static_files = load_static_files(static_dir)
     yield
+    await close_shared_resources()
 
 app = FastAPI(
     title="Gemini Budget API",
@@ -30,12 +71,31 @@ if settings.DEV_MODE:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=[NEXT_CURSOR_HEADER],
     )
 
-# Global OPTIONS handler for non-CORS requests
-@app.options("/{path:path}")
+# Flag requests that run many statements (typically an N+1 loop) while developing
+if settings.DEV_MODE:
+    @app.middleware("http")
+    async def warn_on_query_count(request: Request, call_next):
+        with count_queries() as queries:
+            response = await call_next(request)
+        if queries.count > settings.QUERY_COUNT_WARN:
+            print(f"Warning: {request.method} {request.url.path} ran {queries.count} SQL statements")
+        return response
+
+# Compress JSON lists; small bodies (OPTIONS 204s, short messages) are passed through as-is
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)  # type: ignore
+
+# Global OPTIONS handler for non-CORS requests (empty 204, no JSON encoding)
+@app.options("/{path:path}", status_code=204, response_class=Response)
 async def options_handler(path: str):
-    return {"message": "ok"}
+    return Response(status_code=204)
+
+# Hashed build assets are served by Starlette directly (stat caching, ETag/304)
+assets_dir = os.path.join(static_dir, "assets")
+if os.path.isdir(assets_dir):
+    app.mount("/assets", StaticFiles(directory=assets_dir), name="assets")
 
 # Register routers
 app.include_router(accounts.router)
@@ -46,19 +106,32 @@ app.include_router(proposals.router)
 app.include_router(report.router)
 app.include_router(merchants.router)
 
-# Serve built frontend
-static_dir = os.path.join(os.path.dirname(__file__), "static")
+@app.get("/health/db", response_model=Dict[str, str])
+async def health_db(db: AsyncSession = Depends(get_db)):
+    # Round-trips a trivial statement. Pool usage (checked in/out, overflow) is
+    # internal, so it is only reported while developing.
+    await db.execute(text("SELECT 1"))
+    if settings.DEV_MODE:
+        return {"status": "ok", "pool": engine.pool.status()}
+    return {"status": "ok"}
 
 # Catch-all for SPA
 @app.get("/{full_path:path}")
 async def serve_spa(full_path: str):
-    # Check if the requested path is a file in static dir (like assets/...)
-    file_path = os.path.join(static_dir, full_path)
-    if os.path.isfile(file_path):
-        return FileResponse(file_path)
+    static_files = getattr(app.state, "static_files", {})
+    url_path = posixpath.normpath("/" + full_path).lstrip("/")
+    if url_path.startswith("assets/"):
+        # Frontend not built: a missing asset is not an SPA route
+        raise HTTPException(status_code=404, detail="Not Found")
+    # Check if the requested path is a file in static dir (like favicon.ico)
+    if url_path in static_files:
+        body, media_type = static_files[url_path]
+        return Response(content=body, media_type=media_type)
+    if url_path in getattr(app.state, "large_static_files", ()):
+        return FileResponse(os.path.join(static_dir, url_path))
     # Otherwise, serve index.html for SPA routing (if it exists)
-    index_path = os.path.join(static_dir, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(index_path)
+    if "index.html" in static_files:
+        body, media_type = static_files["index.html"]
+        return Response(content=body, media_type=media_type)
     # Fallback if static files are not built yet
     return {"message": "Gemini Budget API is running. Frontend not found."}
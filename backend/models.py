@@ -1,13 +1,63 @@
+import os
+import time
 import uuid
-from datetime import datetime, timezone
+import orjson
+from datetime import datetime
 from typing import List, Optional
-from sqlalchemy import String, ForeignKey, DateTime, Text, JSON, Float, Table, Column
-from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.dialects.sqlite import JSON as SQLiteJSON
+from sqlalchemy import DDL, String, ForeignKey, DateTime, Text, JSON, Float, Table, Column, Index, event, text
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
 from .database import Base
 
 def gen_uuid():
-    return str(uuid.uuid4())
+    """
+    Returns a UUIDv7 string: a 48-bit millisecond timestamp followed by random bits.
+    Keys sort by creation time, so inserts append to the end of the PK/FK indexes
+    instead of scattering across random B-tree pages.
+    """
+    value = (time.time_ns() // 1_000_000 & 0xFFFF_FFFF_FFFF) << 80
+    value |= int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)  # version 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)  # RFC 4122 variant
+    return str(uuid.UUID(int=value))
+
+class UtcNow(FunctionElement):
+    """Server-side UTC timestamp, rendered per dialect."""
+    type = DateTime()
+    inherit_cache = True
+
+@compiles(UtcNow)
+def _utc_now_default(element, compiler, **kw):
+    return "timezone('utc', now())"
+
+# On SQLite, the same text layout SQLAlchemy binds DateTime values with
+# (microsecond precision), so stamped and bound values compare correctly in
+# filters and keyset cursors.
+@compiles(UtcNow, "sqlite")
+def _utc_now_sqlite(element, compiler, **kw):
+    return "(strftime('%Y-%m-%d %H:%M:%f', 'now') || '000')"
+
+utc_now = UtcNow()
+
+class OrjsonType(TypeDecorator):
+    """
+    JSON stored as TEXT, encoded and decoded with orjson rather than the stdlib
+    json module that SQLAlchemy's JSON type calls on every row.
+    """
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return orjson.loads(value)
 
 # Linker table for Transaction <-> Document
 transaction_document = Table(
@@ -15,7 +65,7 @@ transaction_document = Table(
     Base.metadata,
     Column("transaction_id", String, ForeignKey("transaction.id"), primary_key=True),
     Column("document_id", String, ForeignKey("document.id"), primary_key=True),
-    Column("attached_at", DateTime, default=lambda: datetime.now(timezone.utc)),
+    Column("attached_at", DateTime, server_default=utc_now),
 )
 
 class User(Base):
@@ -24,7 +74,7 @@ class User(Base):
     id: Mapped[str] = mapped_column(String, primary_key=True, default=gen_uuid)
     email: Mapped[str] = mapped_column(String, unique=True, index=True)
     full_name: Mapped[Optional[str]] = mapped_column(String)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=utc_now)
     
     accounts: Mapped[List["Account"]] = relationship(back_populates="user", cascade="all, delete-orphan")
     categories: Mapped[List["Category"]] = relationship(back_populates="user", cascade="all, delete-orphan")
@@ -35,6 +85,9 @@ class User(Base):
 
 class Account(Base):
     __tablename__ = "account"
+    __table_args__ = (
+        Index("ix_account_user_name", "user_id", "name"),
+    )
     
     id: Mapped[str] = mapped_column(String, primary_key=True, default=gen_uuid)
     user_id: Mapped[str] = mapped_column(String, ForeignKey("user.id", ondelete="CASCADE"))
@@ -44,7 +97,7 @@ class Account(Base):
     current_balance: Mapped[float] = mapped_column(Float, default=0.0)
     currency: Mapped[str] = mapped_column(String, default="USD")
     description: Mapped[Optional[str]] = mapped_column(Text)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=utc_now)
     
     user: Mapped["User"] = relationship(back_populates="accounts")
     transactions: Mapped[List["Transaction"]] = relationship(
@@ -55,6 +108,9 @@ class Account(Base):
 
 class Category(Base):
     __tablename__ = "category"
+    __table_args__ = (
+        Index("ix_category_user_name_id", "user_id", "name", "id"),
+    )
     
     id: Mapped[str] = mapped_column(String, primary_key=True, default=gen_uuid)
     user_id: Mapped[str] = mapped_column(String, ForeignKey("user.id", ondelete="CASCADE"))
@@ -69,6 +125,26 @@ class Category(Base):
 
 class Transaction(Base):
     __tablename__ = "transaction"
+    __table_args__ = (
+        # id completes the (transaction_date, id) list order, so keyset pages are index range scans
+        Index("ix_transaction_user_date_id", "user_id", "transaction_date", "id"),
+        # Balance recalculation sums by account on either side of a transfer
+        Index("ix_transaction_account", "account_id"),
+        Index("ix_transaction_target_account", "target_account_id"),
+        # Trigram indexes serve the '%q%' ILIKE search on PostgreSQL. SQLite cannot use
+        # an index for a leading wildcard, so there the search scans the user's rows
+        # through ix_transaction_user_date_id and these are not created.
+        Index(
+            "ix_transaction_merchant_trgm", "merchant",
+            postgresql_using="gin", postgresql_ops={"merchant": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+        Index(
+            "ix_transaction_note_trgm", "note",
+            postgresql_using="gin", postgresql_ops={"note": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+    # Fetch server-generated timestamps via RETURNING on INSERT and UPDATE
+    __mapper_args__ = {"eager_defaults": True}
     
     id: Mapped[str] = mapped_column(String, primary_key=True, default=gen_uuid)
     user_id: Mapped[str] = mapped_column(String, ForeignKey("user.id", ondelete="CASCADE"))
@@ -82,8 +158,8 @@ class Transaction(Base):
     note: Mapped[Optional[str]] = mapped_column(Text)
     merchant: Mapped[Optional[str]] = mapped_column(String)
     
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=utc_now)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=utc_now, onupdate=utc_now)
     
     user: Mapped["User"] = relationship(back_populates="transactions")
     account: Mapped["Account"] = relationship(foreign_keys=[account_id], back_populates="transactions")
@@ -94,8 +170,25 @@ class Transaction(Base):
         secondary=transaction_document, back_populates="transactions"
     )
 
+# gin_trgm_ops needs the extension before the transaction indexes are created
+event.listen(
+    Base.metadata, "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
+# Column attributes that update payloads may set; keys, ownership and timestamps
+# are excluded, and relationship names are not columns
+UPDATABLE_TRANSACTION_COLUMNS = frozenset(Transaction.__table__.columns.keys()) - {
+    "id", "user_id", "created_at", "updated_at"
+}
+
 class Document(Base):
     __tablename__ = "document"
+    __table_args__ = (
+        Index("ix_document_user_created", "user_id", "created_at"),
+        # Finds an earlier upload of the same file; not unique, re-uploads keep their own row
+        Index("ix_document_user_sha256", "user_id", "content_sha256"),
+    )
     
     id: Mapped[str] = mapped_column(String, primary_key=True, default=gen_uuid)
     user_id: Mapped[str] = mapped_column(String, ForeignKey("user.id", ondelete="CASCADE"))
@@ -104,7 +197,9 @@ class Document(Base):
     mime_type: Mapped[str] = mapped_column(String)
     user_note: Mapped[Optional[str]] = mapped_column(Text)
     status: Mapped[str] = mapped_column(String, default="UPLOADED") # UPLOADED, PARSING, PROCESSED, ERROR
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
+    # Hex SHA-256 of the file, computed while the upload streams to disk
+    content_sha256: Mapped[Optional[str]] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=utc_now)
     
     user: Mapped["User"] = relationship(back_populates="documents")
     proposals: Mapped[List["ProposedChange"]] = relationship(back_populates="document")
@@ -112,8 +207,23 @@ class Document(Base):
         secondary=transaction_document, back_populates="documents"
     )
 
+# Predicate of the partial unique index on pending proposals; the upsert repeats it
+# verbatim as its conflict target
+PENDING_ONLY = text("status = 'PENDING'")
+
 class ProposedChange(Base):
     __tablename__ = "proposed_change"
+    __table_args__ = (
+        # created_at last: pending proposals are read in creation order straight off the index
+        Index("ix_proposed_change_user_status_created", "user_id", "status", "created_at"),
+        # One pending proposal per (document, target transaction): the conflict target of
+        # the proposal upsert. Decided proposals stay as history and never collide, nor
+        # do NULL targets (new transactions).
+        Index(
+            "ux_proposed_change_document_target_pending", "document_id", "target_transaction_id",
+            unique=True, sqlite_where=PENDING_ONLY, postgresql_where=PENDING_ONLY,
+        ),
+    )
     
     id: Mapped[str] = mapped_column(String, primary_key=True, default=gen_uuid)
     user_id: Mapped[str] = mapped_column(String, ForeignKey("user.id", ondelete="CASCADE"))
@@ -123,10 +233,10 @@ class ProposedChange(Base):
     change_type: Mapped[str] = mapped_column(String)  # CREATE_NEW, UPDATE_EXISTING
     status: Mapped[str] = mapped_column(String, default="PENDING")  # PENDING, APPROVED, REJECTED
     
-    proposed_data: Mapped[dict] = mapped_column(SQLiteJSON)
+    proposed_data: Mapped[dict] = mapped_column(OrjsonType)
     confidence_score: Mapped[Optional[float]] = mapped_column(Float)
     
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=utc_now)
     
     user: Mapped["User"] = relationship(back_populates="proposals")
     document: Mapped["Document"] = relationship(back_populates="proposals")
@@ -134,11 +244,27 @@ class ProposedChange(Base):
 
 class Merchant(Base):
     __tablename__ = "merchant"
+    __table_args__ = (
+        Index("ix_merchant_user_name_lower", "user_id", "name_lower"),
+        # Serves the agent context's '%name%' merchant match on PostgreSQL, like the
+        # transaction trigram indexes
+        Index(
+            "ix_merchant_name_lower_trgm", "name_lower",
+            postgresql_using="gin", postgresql_ops={"name_lower": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
     
     id: Mapped[str] = mapped_column(String, primary_key=True, default=gen_uuid)
     user_id: Mapped[str] = mapped_column(String, ForeignKey("user.id", ondelete="CASCADE"))
     name: Mapped[str] = mapped_column(String, index=True)
+    # Lowercased copy of name, kept in sync on write so lookups can use the index
+    name_lower: Mapped[str] = mapped_column(String)
     default_category_id: Mapped[Optional[str]] = mapped_column(String, ForeignKey("category.id", ondelete="SET NULL"))
     
     user: Mapped["User"] = relationship(back_populates="merchants")
     default_category: Mapped[Optional["Category"]] = relationship()
+
+    @validates("name")
+    def _sync_name_lower(self, key, value):
+        self.name_lower = value.lower() if value else value
+        return value
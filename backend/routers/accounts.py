@@ -1,71 +1,67 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Response, status
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
-from ..database import get_db
-from ..models import Account, User
+from ..models import Account
 from ..schemas import AccountCreate, AccountUpdate, Account as AccountSchema
-from ..dependencies import get_current_user, PaginationParams
+from ..dependencies import AuthedSession, authed, get_owned_or_404, paginate, set_next_cursor, PaginationParams
+from ..services.document_processor import invalidate_agent_context
 
 router = APIRouter(prefix="/accounts", tags=["accounts"])
 
-@router.get("/", response_model=List[AccountSchema])
+_ACCOUNT_ORDER = (Account.created_at, Account.id)
+
+@router.get("/", response_model=List[AccountSchema], response_model_exclude_none=True)
 async def list_accounts(
+    response: Response,
     pagination: PaginationParams = Depends(),
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    query = select(Account).where(Account.user_id == current_user.id).offset(pagination.skip).limit(pagination.limit)
+    db, current_user = ctx
+    query = paginate(select(Account).where(Account.user_id == current_user.id), pagination, *_ACCOUNT_ORDER)
     result = await db.execute(query)
-    return result.scalars().all()
+    accounts = result.scalars().all()
+    set_next_cursor(response, accounts, pagination, *_ACCOUNT_ORDER)
+    return accounts
 
 @router.post("/", response_model=AccountSchema)
 async def create_account(
     account: AccountCreate,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
     db_account = Account(**account.model_dump(), user_id=current_user.id)
     db.add(db_account)
     await db.commit()
-    await db.refresh(db_account)
+    invalidate_agent_context(current_user.id)
     return db_account
 
 @router.patch("/{account_id}", response_model=AccountSchema)
 async def update_account(
     account_id: str,
     account_update: AccountUpdate,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    result = await db.execute(
-        select(Account).where(Account.id == account_id, Account.user_id == current_user.id)
-    )
-    db_account = result.scalars().first()
-    if not db_account:
-        raise HTTPException(status_code=404, detail="Account not found")
+    db, current_user = ctx
+    db_account = await get_owned_or_404(db, Account, account_id, current_user.id)
     
     update_data = account_update.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(db_account, key, value)
     
     await db.commit()
+    invalidate_agent_context(current_user.id)
     await db.refresh(db_account)
     return db_account
 
 @router.delete("/{account_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_account(
     account_id: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    result = await db.execute(
-        select(Account).where(Account.id == account_id, Account.user_id == current_user.id)
-    )
-    db_account = result.scalars().first()
-    if not db_account:
-        raise HTTPException(status_code=404, detail="Account not found")
+    db, current_user = ctx
+    db_account = await get_owned_or_404(db, Account, account_id, current_user.id)
     
     await db.delete(db_account)
     await db.commit()
+    invalidate_agent_context(current_user.id)
     return None
@@ -1,49 +1,49 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Response, status
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
-from ..database import get_db
-from ..models import Category, User
+from ..models import Category
 from ..schemas import CategoryCreate, Category as CategorySchema
-from ..dependencies import get_current_user, PaginationParams
+from ..dependencies import AuthedSession, authed, get_owned_or_404, paginate, set_next_cursor, PaginationParams
+from ..services.document_processor import invalidate_agent_context
 
 router = APIRouter(prefix="/categories", tags=["categories"])
 
-@router.get("/", response_model=List[CategorySchema])
+_CATEGORY_ORDER = (Category.name, Category.id)
+
+@router.get("/", response_model=List[CategorySchema], response_model_exclude_none=True)
 async def list_categories(
+    response: Response,
     pagination: PaginationParams = Depends(),
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    query = select(Category).where(Category.user_id == current_user.id).offset(pagination.skip).limit(pagination.limit)
+    db, current_user = ctx
+    query = paginate(select(Category).where(Category.user_id == current_user.id), pagination, *_CATEGORY_ORDER)
     result = await db.execute(query)
-    return result.scalars().all()
+    categories = result.scalars().all()
+    set_next_cursor(response, categories, pagination, *_CATEGORY_ORDER)
+    return categories
 
 @router.post("/", response_model=CategorySchema)
 async def create_category(
     category: CategoryCreate,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
     db_category = Category(**category.model_dump(), user_id=current_user.id)
     db.add(db_category)
     await db.commit()
-    await db.refresh(db_category)
+    invalidate_agent_context(current_user.id)
     return db_category
 
 @router.delete("/{category_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_category(
     category_id: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    result = await db.execute(
-        select(Category).where(Category.id == category_id, Category.user_id == current_user.id)
-    )
-    db_category = result.scalars().first()
-    if not db_category:
-        raise HTTPException(status_code=404, detail="Category not found")
+    db, current_user = ctx
+    db_category = await get_owned_or_404(db, Category, category_id, current_user.id)
     
     await db.delete(db_category)
     await db.commit()
+    invalidate_agent_context(current_user.id)
     return None
@@ -1,34 +1,40 @@
-import shutil
-import uuid
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, status, BackgroundTasks
+import hashlib
+import aiofiles
+from pathlib import PurePath
+from fastapi import APIRouter, Depends, Response, UploadFile, File, Form, status, BackgroundTasks
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
-from ..database import get_db
-from ..models import Document, User
+from ..models import Document, gen_uuid
 from ..schemas import Document as DocumentSchema
-from ..dependencies import get_current_user, PaginationParams
+from ..dependencies import AuthedSession, authed, get_owned_or_404, paginate, set_next_cursor, PaginationParams
 from ..config import settings
 from ..services.document_processor import process_document_task
 
 router = APIRouter(prefix="/documents", tags=["documents"])
 
+# Newest uploads first
+_DOCUMENT_ORDER = (Document.created_at, Document.id)
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 @router.post("/upload", response_model=DocumentSchema)
 async def upload_document(
     file: UploadFile = File(...),
     user_note: Optional[str] = Form(None),
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    ctx: AuthedSession = Depends(authed),
     background_tasks: BackgroundTasks = BackgroundTasks()
 ):
-    file_id = str(uuid.uuid4())
-    filename = file.filename or ""
-    extension = filename.split(".")[-1] if "." in filename else ""
-    safe_filename = f"{file_id}.{extension}" if extension else file_id
-    file_path = settings.UPLOAD_DIR / safe_filename
+    db, current_user = ctx
+    file_id = gen_uuid()
+    extension = PurePath(file.filename or "").suffix
+    file_path = settings.UPLOAD_DIR / f"{file_id}{extension}"
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Stream to disk in 1 MiB chunks without blocking the event loop, hashing as we go
+    digest = hashlib.sha256()
+    async with aiofiles.open(file_path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            await buffer.write(chunk)
     
     db_document = Document(
         id=file_id,
@@ -37,39 +43,39 @@ async def upload_document(
         file_path=str(file_path),
         mime_type=file.content_type,
         user_note=user_note,
-        status="UPLOADED"
+        status="UPLOADED",
+        content_sha256=digest.hexdigest(),
     )
     
     db.add(db_document)
     await db.commit()
-    await db.refresh(db_document)
     
     background_tasks.add_task(process_document_task, db_document.id)
         
     return db_document
 
-@router.get("/", response_model=List[DocumentSchema])
+@router.get("/", response_model=List[DocumentSchema], response_model_exclude_none=True)
 async def list_documents(
+    response: Response,
     pagination: PaginationParams = Depends(),
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    query = select(Document).where(Document.user_id == current_user.id).offset(pagination.skip).limit(pagination.limit)
+    db, current_user = ctx
+    query = paginate(
+        select(Document).where(Document.user_id == current_user.id), pagination, *_DOCUMENT_ORDER, descending=True
+    )
     result = await db.execute(query)
-    return result.scalars().all()
+    documents = result.scalars().all()
+    set_next_cursor(response, documents, pagination, *_DOCUMENT_ORDER)
+    return documents
 
 @router.delete("/{document_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_document(
     document_id: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    result = await db.execute(
-        select(Document).where(Document.id == document_id, Document.user_id == current_user.id)
-    )
-    db_document = result.scalars().first()
-    if not db_document:
-        raise HTTPException(status_code=404, detail="Document not found")
+    db, current_user = ctx
+    db_document = await get_owned_or_404(db, Document, document_id, current_user.id)
     
     # In a real app we might also delete the file from disk
     # path = Path(db_document.file_path)
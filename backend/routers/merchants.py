@@ -1,77 +1,73 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Response, status
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
-from ..database import get_db
-from ..models import Merchant, User
+from ..models import Merchant
 from ..schemas import MerchantCreate, MerchantUpdate, Merchant as MerchantSchema
-from ..dependencies import get_current_user, PaginationParams
+from ..dependencies import AuthedSession, authed, get_owned_or_404, paginate, set_next_cursor, PaginationParams
+from ..services.document_processor import invalidate_agent_context
 
 router = APIRouter(prefix="/merchants", tags=["merchants"])
 
-@router.get("/", response_model=List[MerchantSchema])
+_MERCHANT_ORDER = (Merchant.name_lower, Merchant.id)
+
+@router.get("/", response_model=List[MerchantSchema], response_model_exclude_none=True)
 async def list_merchants(
+    response: Response,
     q: Optional[str] = None,
     pagination: PaginationParams = Depends(),
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
     query = select(Merchant).where(Merchant.user_id == current_user.id)
     
     if q:
-        query = query.where(Merchant.name.ilike(f"%{q}%"))
+        query = query.where(Merchant.name_lower.like(f"%{q.lower()}%"))
         
-    query = query.offset(pagination.skip).limit(pagination.limit)
+    query = paginate(query, pagination, *_MERCHANT_ORDER)
     result = await db.execute(query)
-    return result.scalars().all()
+    merchants = result.scalars().all()
+    set_next_cursor(response, merchants, pagination, *_MERCHANT_ORDER)
+    return merchants
 
 @router.post("/", response_model=MerchantSchema)
 async def create_merchant(
     merchant: MerchantCreate,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
     db_merchant = Merchant(**merchant.model_dump(), user_id=current_user.id)
     db.add(db_merchant)
     await db.commit()
-    await db.refresh(db_merchant)
+    invalidate_agent_context(current_user.id)
     return db_merchant
 
 @router.patch("/{merchant_id}", response_model=MerchantSchema)
 async def update_merchant(
     merchant_id: str,
     merchant_update: MerchantUpdate,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    result = await db.execute(
-        select(Merchant).where(Merchant.id == merchant_id, Merchant.user_id == current_user.id)
-    )
-    db_merchant = result.scalars().first()
-    if not db_merchant:
-        raise HTTPException(status_code=404, detail="Merchant not found")
+    db, current_user = ctx
+    db_merchant = await get_owned_or_404(db, Merchant, merchant_id, current_user.id)
     
     update_data = merchant_update.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(db_merchant, key, value)
     
     await db.commit()
+    invalidate_agent_context(current_user.id)
     await db.refresh(db_merchant)
     return db_merchant
 
 @router.delete("/{merchant_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_merchant(
     merchant_id: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    result = await db.execute(
-        select(Merchant).where(Merchant.id == merchant_id, Merchant.user_id == current_user.id)
-    )
-    db_merchant = result.scalars().first()
-    if not db_merchant:
-        raise HTTPException(status_code=404, detail="Merchant not found")
+    db, current_user = ctx
+    db_merchant = await get_owned_or_404(db, Merchant, merchant_id, current_user.id)
     
     await db.delete(db_merchant)
     await db.commit()
+    invalidate_agent_context(current_user.id)
     return None
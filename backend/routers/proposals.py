@@ -1,40 +1,51 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from datetime import datetime, timezone
+from sqlalchemy import insert
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
-from ..database import get_db
-from ..models import ProposedChange, Transaction, User, Account, Category, Document
+from sqlalchemy.orm import joinedload
+from typing import Dict, List, Optional
+from ..models import (
+    ProposedChange, Transaction, Account, Category, Document, UPDATABLE_TRANSACTION_COLUMNS, gen_uuid, transaction_document
+)
 from ..schemas import ProposedChange as ProposedChangeSchema, ProposedChangeConfirm
-from ..services.account_service import recalculate_account_balance
-from ..dependencies import get_current_user, PaginationParams
+from ..services.account_service import recalculate_account_balance, recalculate_account_balances
+from ..dependencies import AuthedSession, authed, paginate, set_next_cursor, PaginationParams
+from ..services.document_processor import invalidate_agent_context
 
 router = APIRouter(prefix="/proposals", tags=["proposals"])
 
+# Newest proposals first
+_PROPOSAL_ORDER = (ProposedChange.created_at, ProposedChange.id)
+
 @router.get("/", response_model=List[ProposedChangeSchema])
 async def list_proposals(
+    response: Response,
     pagination: PaginationParams = Depends(),
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    query = (
-        select(ProposedChange)
-        .where(ProposedChange.user_id == current_user.id, ProposedChange.status == "PENDING")
-        .offset(pagination.skip)
-        .limit(pagination.limit)
+    db, current_user = ctx
+    query = paginate(
+        select(ProposedChange).where(ProposedChange.user_id == current_user.id, ProposedChange.status == "PENDING"),
+        pagination,
+        *_PROPOSAL_ORDER,
+        descending=True,
     )
     result = await db.execute(query)
-    return result.scalars().all()
+    proposals = result.scalars().all()
+    set_next_cursor(response, proposals, pagination, *_PROPOSAL_ORDER)
+    return proposals
 
-@router.post("/{proposal_id}/confirm")
+@router.post("/{proposal_id}/confirm", response_model=Dict[str, str])
 async def confirm_proposal(
     proposal_id: str,
     action: ProposedChangeConfirm,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
     result = await db.execute(
-        select(ProposedChange).where(ProposedChange.id == proposal_id, ProposedChange.user_id == current_user.id)
+        select(ProposedChange)
+        .options(joinedload(ProposedChange.document))
+        .where(ProposedChange.id == proposal_id, ProposedChange.user_id == current_user.id)
     )
     db_proposal = result.scalars().first()
     if not db_proposal:
@@ -50,14 +61,15 @@ async def confirm_proposal(
         data = db_proposal.proposed_data.copy()
         if action.edited_data:
             data.update(action.edited_data)
+
+        # Source document (loaded with the proposal), linked to every transaction it creates
+        doc = db_proposal.document
         
         if db_proposal.change_type == "CREATE_NEW":
-            new_tx = await _create_transaction_from_data(data, current_user.id, proposal_id, db)
+            new_tx = _create_transaction_from_data(data, current_user.id, doc)
             db.add(new_tx)
             await db.flush()
-            await recalculate_account_balance(db, new_tx.account_id)
-            if new_tx.target_account_id:
-                await recalculate_account_balance(db, new_tx.target_account_id)
+            await recalculate_account_balances(db, {new_tx.account_id, new_tx.target_account_id})
 
         elif db_proposal.change_type == "CREATE_ACCOUNT":
             # Handle one or more transactions, with optional new account creation
@@ -75,7 +87,9 @@ async def confirm_proposal(
                         acc_sub_type = acc_type
                     acc_type = "ASSET"
                 
+                # Client-side id, so the account needs no flush of its own
                 new_acc = Account(
+                    id=gen_uuid(),
                     user_id=current_user.id,
                     name=acc_data.get("name"),
                     type=acc_type,
@@ -84,7 +98,6 @@ async def confirm_proposal(
                     description=acc_data.get("description")
                 )
                 db.add(new_acc)
-                await db.flush()
                 acc_id = new_acc.id
             
             if not acc_id:
@@ -126,69 +139,64 @@ async def confirm_proposal(
                     note="Initial balance from document"
                 )
                 db.add(ob_tx)
-                await db.flush()
 
+            # New account and opening balance go out in one flush
+            await db.flush()
+
+            # Insert all transactions (and their document links) as two bulk statements
+            rows = []
             for tx_item in transactions:
                 # Ensure the transaction uses the decided account_id
                 tx_item["account_id"] = acc_id
-                new_tx = await _create_transaction_from_data(tx_item, current_user.id, proposal_id, db)
-                db.add(new_tx)
-                await db.flush()
+                rows.append(_transaction_values(tx_item, current_user.id))
+            if rows:
+                await db.execute(insert(Transaction), rows)
+                if doc:
+                    await db.execute(
+                        insert(transaction_document),
+                        [{"transaction_id": row["id"], "document_id": doc.id} for row in rows],
+                    )
+            # Transfer targets of the new transactions
+            target_accounts = {row["target_account_id"] for row in rows}
 
-            # 4. Final balance sync
-            await recalculate_account_balance(db, acc_id)
+            # 4. Final balance sync: the account and every transfer target in one statement
+            balances = await recalculate_account_balances(db, target_accounts | {acc_id})
             if closing_bal is not None:
-                # Fetch fresh account state
-                res_acc = await db.execute(select(Account).where(Account.id == acc_id))
-                updated_acc = res_acc.scalars().first()
-                if updated_acc:
-                    diff = closing_bal - updated_acc.current_balance
-                    if abs(diff) > 0.001:
-                        adj_tx = Transaction(
-                            user_id=current_user.id,
-                            account_id=acc_id,
-                            amount=abs(diff),
-                            type="INCOME" if diff > 0 else "EXPENSE",
-                            transaction_date=datetime.now(timezone.utc),
-                            merchant="Balance Adjustment",
-                            note=f"Adjustment to match document closing balance ({closing_bal})"
-                        )
-                        db.add(adj_tx)
-                        await db.flush()
-                        await recalculate_account_balance(db, acc_id)
-
-            # Recalculate any target accounts (transfers)
-            tx_results = await db.execute(select(Transaction).where(Transaction.user_id == current_user.id, Transaction.account_id == acc_id))
-            for tx in tx_results.scalars().all():
-                if tx.target_account_id:
-                    await recalculate_account_balance(db, tx.target_account_id)
+                diff = closing_bal - balances[acc_id]
+                if abs(diff) > 0.001:
+                    adj_tx = Transaction(
+                        user_id=current_user.id,
+                        account_id=acc_id,
+                        amount=abs(diff),
+                        type="INCOME" if diff > 0 else "EXPENSE",
+                        transaction_date=datetime.now(timezone.utc),
+                        merchant="Balance Adjustment",
+                        note=f"Adjustment to match document closing balance ({closing_bal})"
+                    )
+                    db.add(adj_tx)
+                    await db.flush()
+                    await recalculate_account_balance(db, acc_id)
 
         elif db_proposal.change_type == "UPDATE_EXISTING":
             if not db_proposal.target_transaction_id:
                 raise HTTPException(status_code=400, detail="Missing target transaction for update")
             
-            tx_result = await db.execute(
-                select(Transaction).where(Transaction.id == db_proposal.target_transaction_id)
-            )
-            tx = tx_result.scalars().first()
-            if not tx:
+            tx = await db.get(Transaction, db_proposal.target_transaction_id)
+            if not tx or tx.user_id != current_user.id:
                 raise HTTPException(status_code=404, detail="Target transaction not found")
             
             old_account_id = tx.account_id
             old_target_account_id = tx.target_account_id
             
-            # Fields that should NOT be updated manually from proposal data
-            excluded_fields = {"id", "user_id", "created_at", "updated_at"}
-            
-            for key, value in data.items():
-                if hasattr(tx, key) and key not in excluded_fields:
-                    if key == "transaction_date" and isinstance(value, str):
-                        try:
-                            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
-                        except ValueError:
-                            # Fallback if fromisoformat fails
-                            continue
-                    setattr(tx, key, value)
+            for key in data.keys() & UPDATABLE_TRANSACTION_COLUMNS:
+                value = data[key]
+                if key == "transaction_date" and isinstance(value, str):
+                    try:
+                        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+                    except ValueError:
+                        # Fallback if fromisoformat fails
+                        continue
+                setattr(tx, key, value)
             
             await db.flush()
             
@@ -199,18 +207,19 @@ async def confirm_proposal(
             if tx.target_account_id:
                 affected_accounts.add(tx.target_account_id)
                 
-            for acc_id in affected_accounts:
-                if acc_id:
-                    await recalculate_account_balance(db, acc_id)
+            await recalculate_account_balances(db, affected_accounts)
         
         db_proposal.status = "APPROVED"
         await db.commit()
+        invalidate_agent_context(current_user.id)
         return {"status": "approved"}
         
     raise HTTPException(status_code=400, detail="Invalid action status")
 
-async def _create_transaction_from_data(data: dict, user_id: str, proposal_id: str, db: AsyncSession) -> Transaction:
-    new_tx = Transaction(
+def _transaction_values(data: dict, user_id: str) -> dict:
+    """Column values for a transaction described by proposal data (no IO)."""
+    return dict(
+        id=gen_uuid(),
         user_id=user_id,
         account_id=data.get("account_id"),
         target_account_id=data.get("target_account_id"),
@@ -225,14 +234,11 @@ async def _create_transaction_from_data(data: dict, user_id: str, proposal_id: s
         note=data.get("note") or data.get("description"),
         merchant=data.get("merchant")
     )
+
+def _create_transaction_from_data(data: dict, user_id: str, doc: Optional[Document]) -> Transaction:
+    new_tx = Transaction(**_transaction_values(data, user_id))
     
     # Link to document
-    doc_result = await db.execute(
-        select(Document)
-        .join(ProposedChange, ProposedChange.document_id == Document.id)
-        .where(ProposedChange.id == proposal_id)
-    )
-    doc = doc_result.scalars().first()
     if doc:
         new_tx.documents.append(doc)
     
@@ -1,70 +1,102 @@
 from fastapi import APIRouter, Depends
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import func
+from sqlalchemy import case, func, union_all
 from datetime import datetime
 from collections import defaultdict
 import calendar
 
-from ..database import get_db
-from ..models import Account, User, Transaction
+from ..models import Account, Transaction
 from ..schemas import WealthReport, ReportDataPoint
-from ..dependencies import get_current_user
+from ..dependencies import AuthedSession, authed
 
 router = APIRouter(prefix="/wealth", tags=["wealth"])
 
+# Number of most recent periods charted per interval (years are unbounded)
+MAX_POINTS = {"month": 12, "day": 30}
+
 @router.get("/chart", response_model=WealthReport)
 async def get_wealth_chart(
     interval: str = "month", # day, month, year
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
     """
     Calculates historical wealth data points by rolling back transitions from current account balances.
     """
+    db, current_user = ctx
     # Fetch accounts to distinguish types and get current balances
     acc_result = await db.execute(select(Account).where(Account.user_id == current_user.id))
     accounts = acc_result.scalars().all()
     account_map = {a.id: a for a in accounts}
     
-    # Fetch all transactions sorted by date DESC
-    tx_result = await db.execute(
-        select(Transaction)
-        .where(Transaction.user_id == current_user.id)
-        .order_by(Transaction.transaction_date.desc())
+    if interval == "month":
+        period_format, pg_format = "%Y-%m", "YYYY-MM"
+    elif interval == "day":
+        period_format, pg_format = "%Y-%m-%d", "YYYY-MM-DD"
+    else: # year
+        period_format, pg_format = "%Y", "YYYY"
+
+    now = datetime.now()
+    now_key = now.strftime(period_format)
+
+    # Let the database reduce transactions to the signed net change per
+    # (period, account), so Python only folds a few rows per displayed period.
+    if db.get_bind().dialect.name == "sqlite":
+        # Dates are stored as ISO text, so the period key is a plain prefix of the
+        # column and substr() avoids parsing every row the way strftime() would.
+        period = func.substr(Transaction.transaction_date, 1, len(now_key))
+    else:
+        period = func.to_char(Transaction.transaction_date, pg_format)
+    period = period.label("period")
+    filters = [Transaction.user_id == current_user.id]
+    max_points = MAX_POINTS.get(interval)
+    if max_points:
+        # Only the most recent periods are charted, so older transactions are never
+        # rolled back. The start of the oldest charted period bounds transaction_date
+        # (an index range scan).
+        recent_periods = await db.execute(
+            select(period)
+            .where(Transaction.user_id == current_user.id)
+            .distinct()
+            .order_by(period.desc())
+            .limit(max_points)
+        )
+        oldest = min(recent_periods.scalars(), default=None)
+        if oldest is not None:
+            filters.append(Transaction.transaction_date >= datetime.strptime(oldest, period_format))
+
+    # Income adds to the account; expenses and outgoing transfers subtract
+    signed_amount = case(
+        (Transaction.type == "INCOME", Transaction.amount),
+        (Transaction.type.in_(["EXPENSE", "TRANSFER"]), -Transaction.amount),
+        else_=0,
     )
-    transactions = tx_result.scalars().all()
+    outflows = (
+        select(period, Transaction.account_id, func.sum(signed_amount))
+        .where(*filters)
+        .group_by(period, Transaction.account_id)
+    )
+    transfers_in = (
+        select(period, Transaction.target_account_id, func.sum(Transaction.amount))
+        .where(*filters, Transaction.type == "TRANSFER", Transaction.target_account_id.is_not(None))
+        .group_by(period, Transaction.target_account_id)
+    )
+    tx_result = await db.execute(union_all(outflows, transfers_in))
     
     # Track balances backwards from now
     temp_balances = {a.id: a.current_balance for a in accounts}
-    now = datetime.now()
     
-    # Group transactions by interval
-    txs_by_period = defaultdict(list)
-    for tx in transactions:
-        if interval == "month":
-            period_key = tx.transaction_date.strftime("%Y-%m")
-        elif interval == "day":
-            period_key = tx.transaction_date.strftime("%Y-%m-%d")
-        else: # year
-            period_key = tx.transaction_date.strftime("%Y")
-        txs_by_period[period_key].append(tx)
+    # Net balance change per period and account, so rolling back a period
+    # touches each account once
+    deltas_by_period = defaultdict(lambda: defaultdict(float))
+    for period_key, account_id, delta in tx_result:
+        deltas_by_period[period_key][account_id] += delta
         
     # Get all period keys
-    if interval == "month":
-        now_key = now.strftime("%Y-%m")
-    elif interval == "day":
-        now_key = now.strftime("%Y-%m-%d")
-    else:
-        now_key = now.strftime("%Y")
-        
-    all_periods = sorted(list(txs_by_period.keys() | {now_key}), reverse=True)
+    all_periods = sorted(list(deltas_by_period.keys() | {now_key}), reverse=True)
     
     # Limit number of points
-    if interval == "month" and len(all_periods) > 12:
-        all_periods = all_periods[:12]
-    elif interval == "day" and len(all_periods) > 30:
-        all_periods = all_periods[:30]
+    if max_points and len(all_periods) > max_points:
+        all_periods = all_periods[:max_points]
         
     data_points = []
     
@@ -104,19 +136,9 @@ async def get_wealth_chart(
         ))
         
         # Roll back balances for this period to get state at the end of the *previous* period
-        period_txs = txs_by_period[period_key]
-        for tx in period_txs:
-            if tx.type == "INCOME":
-                if tx.account_id in temp_balances:
-                    temp_balances[tx.account_id] -= tx.amount
-            elif tx.type == "EXPENSE":
-                if tx.account_id in temp_balances:
-                    temp_balances[tx.account_id] += tx.amount
-            elif tx.type == "TRANSFER":
-                if tx.account_id in temp_balances:
-                    temp_balances[tx.account_id] += tx.amount
-                if tx.target_account_id in temp_balances:
-                    temp_balances[tx.target_account_id] -= tx.amount
+        for account_id, delta in deltas_by_period.get(period_key, {}).items():
+            if account_id in temp_balances:
+                temp_balances[account_id] -= delta
                     
     data_points.reverse()
     return WealthReport(data_points=data_points)
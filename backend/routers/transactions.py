@@ -1,26 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, Response, status, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.future import select
-from sqlalchemy import or_, and_
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, and_, delete, update
+from sqlalchemy.orm import joinedload
 from typing import List, Optional
 from datetime import datetime
-from ..database import get_db
-from ..models import Transaction, User, Document
+from ..models import Transaction, UPDATABLE_TRANSACTION_COLUMNS, transaction_document
 from ..schemas import TransactionCreate, TransactionUpdate, Transaction as TransactionSchema, Document as DocumentSchema
-from ..dependencies import get_current_user, PaginationParams
-from ..services.account_service import recalculate_account_balance
+from ..dependencies import AuthedSession, authed, get_owned_or_404, paginate, set_next_cursor, PaginationParams
+from ..services.account_service import recalculate_account_balances
+from ..services.document_processor import invalidate_agent_context
 
 router = APIRouter(prefix="/transactions", tags=["transactions"])
 
-@router.get("/", response_model=List[TransactionSchema])
+# Most recent transactions first; id breaks ties between same-date rows
+_TRANSACTION_ORDER = (Transaction.transaction_date, Transaction.id)
+EXPORT_BATCH_SIZE = 1000
+
+@router.get("/", response_model=List[TransactionSchema], response_model_exclude_none=True)
 async def list_transactions(
+    response: Response,
     q: Optional[str] = Query(None, description="Search merchant or note"),
     start_date: Optional[datetime] = Query(None, description="Filter by start date"),
     end_date: Optional[datetime] = Query(None, description="Filter by end date"),
     pagination: PaginationParams = Depends(),
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
     query = select(Transaction).where(Transaction.user_id == current_user.id)
     
     if q:
@@ -36,30 +42,56 @@ async def list_transactions(
     if end_date:
         query = query.where(Transaction.transaction_date <= end_date)
     
-    # Order by date descending by default
-    query = query.order_by(Transaction.transaction_date.desc())
-    
-    query = query.offset(pagination.skip).limit(pagination.limit)
+    # Order by date descending by default; a cursor continues after the previous page
+    query = paginate(query, pagination, *_TRANSACTION_ORDER, descending=True)
     
     result = await db.execute(query)
-    return result.scalars().all()
+    transactions = result.scalars().all()
+    set_next_cursor(response, transactions, pagination, *_TRANSACTION_ORDER)
+    return transactions
+
+@router.get("/export")
+async def export_transactions(ctx: AuthedSession = Depends(authed)):
+    """
+    All of the user's transactions as NDJSON, newest first. Rows are streamed from
+    the database in batches of EXPORT_BATCH_SIZE, so memory stays bounded however
+    long the history is.
+    """
+    db, current_user = ctx
+    query = (
+        select(Transaction)
+        .where(Transaction.user_id == current_user.id)
+        .order_by(*(c.desc() for c in _TRANSACTION_ORDER))
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+    async def lines():
+        result = await db.stream_scalars(query)
+        async for partition in result.partitions():
+            yield b"".join(
+                TransactionSchema.model_validate(t).model_dump_json(exclude_none=True).encode() + b"\n"
+                for t in partition
+            )
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 @router.post("/", response_model=TransactionSchema)
 async def create_transaction(
     transaction: TransactionCreate,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    db_transaction = Transaction(**transaction.model_dump(), user_id=current_user.id)
+    db, current_user = ctx
+    # The schema is flat, so its field dict can go to the ORM without a model_dump copy
+    db_transaction = Transaction(**vars(transaction), user_id=current_user.id)
     db.add(db_transaction)
-    await db.commit()
-    await db.refresh(db_transaction)
+    # Flush (timestamps come back via eager_defaults) so the balance update sees the row;
+    # the insert and the balance update then commit together
+    await db.flush()
     
     # Update balance
-    await recalculate_account_balance(db, db_transaction.account_id)
-    if db_transaction.target_account_id:
-        await recalculate_account_balance(db, db_transaction.target_account_id)
+    await recalculate_account_balances(db, {db_transaction.account_id, db_transaction.target_account_id})
     await db.commit()
+    invalidate_agent_context(current_user.id)
 
     return db_transaction
 
@@ -67,88 +99,83 @@ async def create_transaction(
 async def update_transaction(
     transaction_id: str,
     transaction_update: TransactionUpdate,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
-    result = await db.execute(
-        select(Transaction).where(Transaction.id == transaction_id, Transaction.user_id == current_user.id)
-    )
+    db, current_user = ctx
+    # Only the fields the client sent, read straight off the model
+    update_data = {
+        key: getattr(transaction_update, key)
+        for key in transaction_update.model_fields_set & UPDATABLE_TRANSACTION_COLUMNS
+    }
+    if not update_data:
+        return await get_owned_or_404(db, Transaction, transaction_id, current_user.id)
+
+    owned = (Transaction.id == transaction_id, Transaction.user_id == current_user.id)
+    affected_accounts = set()
+    if update_data.keys() & {"account_id", "target_account_id"}:
+        # Moving the transaction also changes the balances of the accounts it leaves
+        old_result = await db.execute(select(Transaction.account_id, Transaction.target_account_id).where(*owned))
+        old_accounts = old_result.first()
+        if old_accounts is None:
+            raise HTTPException(status_code=404, detail="Transaction not found")
+        affected_accounts.update(old_accounts)
+
+    # One UPDATE ... RETURNING instead of loading the row, mutating it and refreshing it
+    result = await db.execute(update(Transaction).where(*owned).values(**update_data).returning(Transaction))
     db_transaction = result.scalars().first()
     if not db_transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
     
-    update_data = transaction_update.model_dump(exclude_unset=True)
-    old_account_id = db_transaction.account_id
-    old_target_account_id = db_transaction.target_account_id
-    
-    for key, value in update_data.items():
-        setattr(db_transaction, key, value)
-    
-    await db.commit()
-    await db.refresh(db_transaction)
-    
     # Update balances for all affected accounts
-    affected_accounts = {old_account_id, db_transaction.account_id}
-    if old_target_account_id:
-        affected_accounts.add(old_target_account_id)
-    if db_transaction.target_account_id:
-        affected_accounts.add(db_transaction.target_account_id)
-        
-    for acc_id in affected_accounts:
-        if acc_id:
-            await recalculate_account_balance(db, acc_id)
+    affected_accounts.update({db_transaction.account_id, db_transaction.target_account_id})
+    await recalculate_account_balances(db, affected_accounts)
     
     await db.commit()
+    invalidate_agent_context(current_user.id)
     return db_transaction
 
 @router.delete("/{transaction_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_transaction(
     transaction_id: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
+    # DELETE ... RETURNING checks ownership and yields the accounts to rebalance
+    # without loading the row (or its documents collection) into the session
     result = await db.execute(
-        select(Transaction).where(Transaction.id == transaction_id, Transaction.user_id == current_user.id)
+        delete(Transaction)
+        .where(Transaction.id == transaction_id, Transaction.user_id == current_user.id)
+        .returning(Transaction.account_id, Transaction.target_account_id)
     )
-    db_transaction = result.scalars().first()
-    if not db_transaction:
+    deleted = result.first()
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Transaction not found")
-        
-    account_id = db_transaction.account_id
-    target_account_id = db_transaction.target_account_id
+    # The link table has no ON DELETE CASCADE
+    await db.execute(delete(transaction_document).where(transaction_document.c.transaction_id == transaction_id))
     
-    await db.delete(db_transaction)
-    await db.commit()
-    
-    # Update balances
-    await recalculate_account_balance(db, account_id)
-    if target_account_id:
-        await recalculate_account_balance(db, target_account_id)
+    # Update balances in the same commit as the delete
+    await recalculate_account_balances(db, set(deleted))
     await db.commit()
+    invalidate_agent_context(current_user.id)
     
     return None
 
 @router.get("/{transaction_id}/documents", response_model=List[DocumentSchema])
 async def list_transaction_documents(
     transaction_id: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    ctx: AuthedSession = Depends(authed)
 ):
+    db, current_user = ctx
     # This endpoint shows documents which origin of a particular transaction.
     # one transaction could be originated from multiple documents.
+    # The documents are joined onto the owned transaction, so the ownership
+    # check and the document list come back in one round-trip.
     result = await db.execute(
-        select(Transaction).where(Transaction.id == transaction_id, Transaction.user_id == current_user.id)
+        select(Transaction)
+        .options(joinedload(Transaction.documents))
+        .where(Transaction.id == transaction_id, Transaction.user_id == current_user.id)
     )
-    db_transaction = result.scalars().first()
+    db_transaction = result.unique().scalars().first()
     if not db_transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
-    
-    # Need to load the documents relationship
-    # In a real app we might use selectinload, but for simplicity we access it here
-    # Since it's async, we need to be careful. Let's use a query to avoid lazy loading issues.
-    # Actually, SQLAlchemy 2.0 with async requires explicit loading or separate queries.
-    
-    doc_result = await db.execute(
-        select(Document).join(Transaction.documents).where(Transaction.id == transaction_id)
-    )
-    return doc_result.scalars().all()
+    return db_transaction.documents
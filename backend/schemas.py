@@ -1,4 +1,4 @@
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from datetime import datetime
 from typing import List, Optional, Dict, Any
 from enum import Enum
@@ -171,6 +171,14 @@ class MerchantUpdate(BaseModel):
     name: Optional[str] = None
     default_category_id: Optional[str] = None
 
+    @field_validator("name")
+    @classmethod
+    def name_not_null(cls, name: Optional[str]) -> str:
+        # May be left out, but a merchant can't lose its name (name_lower is NOT NULL)
+        if name is None:
+            raise ValueError("name cannot be null")
+        return name
+
 class Merchant(MerchantBase):
     id: str
     user_id: str
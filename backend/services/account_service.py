@@ -1,6 +1,7 @@
+from typing import Iterable
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import func, or_, case
+from sqlalchemy import func, or_, and_, case, update, lambda_stmt
 from ..models import Account, Transaction
 
 async def recalculate_account_balance(db: AsyncSession, account_id: str):
@@ -8,52 +9,48 @@ async def recalculate_account_balance(db: AsyncSession, account_id: str):
     Recalculates and updates the current_balance for a specific account
     by summing all its transactions.
     """
-    # Sum as source account (EXPENSE or TRANSFER out)
-    source_query = select(
-        func.sum(
-            case(
-                (Transaction.type == 'EXPENSE', Transaction.amount),
-                (Transaction.type == 'TRANSFER', Transaction.amount),
-                else_=0
-            )
-        )
-    ).where(Transaction.account_id == account_id)
-    
-    # Sum as primary account (INCOME)
-    income_query = select(
-        func.sum(
-            case(
-                (Transaction.type == 'INCOME', Transaction.amount),
-                else_=0
-            )
-        )
-    ).where(Transaction.account_id == account_id)
+    balances = await recalculate_account_balances(db, [account_id])
+    return balances.get(account_id, 0.0)
 
-    # Sum as target account (TRANSFER in)
-    target_query = select(
-        func.sum(
-            case(
-                (Transaction.type == 'TRANSFER', Transaction.amount),
-                else_=0
-            )
-        )
-    ).where(Transaction.target_account_id == account_id)
-
-    source_res = await db.execute(source_query)
-    income_res = await db.execute(income_query)
-    target_res = await db.execute(target_query)
+async def recalculate_account_balances(db: AsyncSession, account_ids: Iterable[str]) -> dict:
+    """
+    Recalculates current_balance for several accounts with a single
+    UPDATE ... SET current_balance = (correlated SUM) ... RETURNING, so the cost is
+    one round-trip however many accounts are involved. The statement runs on the
+    caller's session because it must see its flushed, uncommitted rows.
+    Returns {account_id: new_balance}.
+    """
+    account_ids = {a for a in account_ids if a}
+    if not account_ids:
+        return {}
 
-    source_sum = source_res.scalar() or 0.0
-    income_sum = income_res.scalar() or 0.0
-    target_sum = target_res.scalar() or 0.0
+    # The statement is built inside lambda_stmt: after the first call SQLAlchemy
+    # reuses the constructed statement and its cache key, and only the ids are rebound.
+    account_ids = list(account_ids)
 
-    new_balance = income_sum + target_sum - source_sum
+    def balance_update():
+        # Income adds to the primary account, expenses and transfers out subtract from it
+        as_source = case(
+            (and_(Transaction.account_id == Account.id, Transaction.type == 'INCOME'), Transaction.amount),
+            (and_(Transaction.account_id == Account.id, Transaction.type.in_(('EXPENSE', 'TRANSFER'))), -Transaction.amount),
+            else_=0
+        )
+        # Transfers in add to the target account
+        as_target = case(
+            (and_(Transaction.target_account_id == Account.id, Transaction.type == 'TRANSFER'), Transaction.amount),
+            else_=0
+        )
+        balance = select(func.coalesce(func.sum(as_source + as_target), 0.0)).where(
+            or_(Transaction.account_id == Account.id, Transaction.target_account_id == Account.id)
+        ).correlate(Account).scalar_subquery()
+        return (
+            update(Account)
+            .where(Account.id.in_(account_ids))
+            .values(current_balance=balance)
+            .returning(Account)
+        )
 
-    # Update the account
-    account_result = await db.execute(select(Account).where(Account.id == account_id))
-    account = account_result.scalars().first()
-    if account:
-        account.current_balance = new_balance
-        await db.flush()
-    
-    return new_balance
+    # RETURNING the entity also refreshes Account objects already in the session
+    result = await db.execute(lambda_stmt(balance_update))
+    balances = {account.id: account.current_balance for account in result.scalars().all()}
+    return {account_id: balances.get(account_id, 0.0) for account_id in account_ids}
@@ -1,41 +1,416 @@
+import io
 import os
-import tempfile
+import re
+import multiprocessing
 from pathlib import Path
-from typing import List, Optional
-from datetime import datetime, timezone
+from typing import List, Literal, Optional
+from datetime import datetime, timedelta, timezone
 import PIL.Image
-from pdf2image import convert_from_path
+import pymupdf
+from cachetools import TTLCache
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from pydantic import BaseModel, Field
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from ..models import Document, Transaction, ProposedChange, Account, Category, Merchant
+from ..models import Document, Transaction, ProposedChange, Account, Category, Merchant, PENDING_ONLY
 from ..config import settings
-from ..database import SessionLocal
-from sqlalchemy import desc, or_
-import json
+from ..database import SessionLocal, dialect_insert, fetch_all_concurrently
+from sqlalchemy import desc, or_, union
+import orjson
 import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import time
+from collections import deque
+
+# Shape of the model's answer, enforced by Gemini's structured output (response_schema)
+class ExtractedTransaction(BaseModel):
+    amount: float
+    merchant: Optional[str] = None
+    transaction_date: str = Field(description="ISO 8601 date")
+    type: Literal["INCOME", "EXPENSE", "TRANSFER"]
+    category_id: Optional[str] = Field(None, description="An id from the context categories, never a name")
+    account_id: Optional[str] = Field(None, description="An id from the context accounts")
+    target_account_id: Optional[str] = None
+    note: Optional[str] = None
+    opening_balance: Optional[float] = None
+    closing_balance: Optional[float] = None
+
+class NewAccountData(BaseModel):
+    name: str
+    type: Literal["ASSET", "LIABILITY"]
+    sub_type: Optional[str] = Field(None, description="e.g. BANK, SAVINGS, CREDIT_CARD, CASH, INVESTMENT")
+    currency: Optional[str] = None
+    description: Optional[str] = None
+    opening_balance: Optional[float] = None
+    closing_balance: Optional[float] = None
+
+class ProposalDecision(BaseModel):
+    type: Literal["CREATE_NEW", "UPDATE_EXISTING", "CREATE_ACCOUNT"]
+    data: Optional[ExtractedTransaction] = Field(None, description="For CREATE_NEW and UPDATE_EXISTING")
+    target_transaction_id: Optional[str] = Field(None, description="For UPDATE_EXISTING")
+    new_account_data: Optional[NewAccountData] = Field(None, description="For CREATE_ACCOUNT")
+    transactions: Optional[List[ExtractedTransaction]] = Field(None, description="For CREATE_ACCOUNT")
+    confidence: float = 0.7
+
+class DocumentDecision(BaseModel):
+    action: Literal["DECIDE"] = "DECIDE"
+    proposals: List[ProposalDecision]
+
+# Fixed instructions, sent as the system instruction so every document's request
+# opens with the same text; the per-user context follows in the contents
+AGENT_INSTRUCTIONS = """
+You are an intelligent accounting assistant. Your goal is to extract all transactions from the following document images
+and decide whether they match existing ones, should be created individually, or part of a batch.
+
+CRITICAL RULES:
+1. Every transaction MUST have an `account_id` if it is a `CREATE_NEW` or `UPDATE_EXISTING`.
+2. If the document clearly belongs to a specific account (e.g., a credit card statement) that is NOT in the context, propose `CREATE_ACCOUNT`.
+3. If you cannot find a matching account in the context or suggestions, use the ID of the "Petty Cash Account".
+4. CATEGORY MATCHING: You MUST use the `id` field from the provided categories list. DO NOT use the category name as an ID. If you cannot find a matching category, use the ID of the category most likely to fit.
+5. ACCOUNT TYPES: When proposing `CREATE_ACCOUNT`, the `type` MUST be exactly 'ASSET' or 'LIABILITY'. Use `sub_type` for specific details (e.g., 'BANK', 'CREDIT_CARD', 'CASH', 'INVESTMENT').
+6. BALANCES: For any document that looks like a statement (e.g., Bank, Credit Card, or Utility Statement), you MUST extract `opening_balance` and `closing_balance`. Include these at the top level of your `DECIDE` proposal data or inside `new_account_data`. This is CRITICAL for ledger reconciliation.
+
+Tools:
+Call `search_transactions` if you need to search for more transactions to confirm a match.
+You may call it several times, including in parallel, before answering.
+
+Answer with a DECIDE action: the final proposal for the document. You can return multiple proposals.
+   Decision Options for each item: 
+   - "CREATE_NEW": No matching transaction found. Provide `data`.
+   - "UPDATE_EXISTING": Match found. Provide `data` and `target_transaction_id`.
+   - "CREATE_ACCOUNT": If transactions belong to a NEW account. Provide `new_account_data` and the list of `transactions`.
+
+Return ONLY a JSON object.
+"""
+
+# The context is serialized once per document, compactly: the model needs no indentation
+CONTEXT_HEADER = "User Context (Accounts, Categories, and Recent Transactions):\n"
 
 class RateLimiter:
+    """
+    Sliding window: lets up to `rpm` calls start in any 60s span. Calls under the
+    limit go through at once, so they can be in flight together; the lock is only
+    held to update the window, never while sleeping.
+    """
+    WINDOW = 60.0
+
     def __init__(self, rpm: int):
-        self.interval = 60.0 / rpm if rpm > 0 else 0
-        self.last_call = 0.0
+        self.rpm = rpm
+        self.calls: deque = deque()
         self.lock = asyncio.Lock()
 
     async def wait(self):
-        if self.interval <= 0:
+        if self.rpm <= 0:
             return
-        async with self.lock:
-            now = time.time()
-            elapsed = now - self.last_call
-            if elapsed < self.interval:
-                await asyncio.sleep(self.interval - elapsed)
-                self.last_call = time.time()
-            else:
-                self.last_call = now
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= self.WINDOW:
+                    self.calls.popleft()
+                if len(self.calls) < self.rpm:
+                    self.calls.append(now)
+                    return
+                # Wait until the oldest call in the window expires, then check again
+                delay = self.WINDOW - (now - self.calls[0])
+            await asyncio.sleep(delay)
 
 gemini_limiter = RateLimiter(settings.GEMINI_RPM)
+# Caps in-flight Gemini requests across all documents being processed
+gemini_semaphore = asyncio.Semaphore(settings.GEMINI_MAX_CONCURRENCY)
+# Quota (429) and overload (503) errors are retried with exponential backoff
+GEMINI_RETRY_STATUSES = (429, 503)
+GEMINI_MAX_ATTEMPTS = 5
+GEMINI_MAX_BACKOFF = 30
+
+def _retry_after(error: errors.APIError) -> Optional[float]:
+    """The server's Retry-After delay in seconds, when the error response carries one."""
+    headers = getattr(error.response, "headers", None) or {}
+    try:
+        return min(float(headers.get("retry-after")), GEMINI_MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return None
+
+async def generate_with_retry(client: genai.Client, **kwargs) -> types.GenerateContentResponse:
+    """
+    generate_content within the rate and concurrency limits. Retryable errors back off
+    1s, 2s, 4s... (or the server's Retry-After) and are raised only once
+    GEMINI_MAX_ATTEMPTS calls have failed.
+    """
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        await gemini_limiter.wait()
+        try:
+            async with gemini_semaphore:
+                return await client.aio.models.generate_content(**kwargs)
+        except errors.APIError as e:
+            if e.code not in GEMINI_RETRY_STATUSES or attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            delay = _retry_after(e) or min(2 ** attempt, GEMINI_MAX_BACKOFF)
+            print(f"Gemini returned {e.code}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+@functools.lru_cache(maxsize=None)
+def get_genai_client() -> genai.Client:
+    """One client per process, so its HTTP connections are reused across documents."""
+    return genai.Client(api_key=settings.GOOGLE_GENAI_KEY)
+
+async def close_shared_resources():
+    """Closes the Gemini client and render pool on shutdown, if they were ever created."""
+    if get_genai_client.cache_info().currsize:
+        await get_genai_client().aio.aclose()
+        get_genai_client.cache_clear()
+    if get_render_pool.cache_info().currsize:
+        get_render_pool().shutdown(cancel_futures=True)
+        get_render_pool.cache_clear()
+
+# A ceiling: the default 150 keeps statements and receipts legible with ~half the
+# pixels of a 200 dpi render, and ordinary pages are held lower by MAX_IMAGE_EDGE
+PDF_RASTER_DPI = settings.PDF_DPI
+# Longest edge sent to Gemini; image tokens (and prefill time) grow with pixel count
+MAX_IMAGE_EDGE = settings.MAX_IMAGE_EDGE
+# PDFs with at least this many pages are rendered across worker processes
+PARALLEL_RENDER_MIN_PAGES = 4
+# Render worker processes; no more than the documents rasterized at once
+RENDER_WORKERS = min(os.cpu_count() or 1, settings.RENDER_CONCURRENCY)
+
+@functools.lru_cache(maxsize=None)
+def get_render_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for rasterizing long PDFs, created on first use. Workers come from
+    a forkserver rather than a fork of this process, which has an event loop and
+    driver threads running.
+    """
+    return ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+
+def _pdf_page_count(file_path: Path) -> int:
+    with pymupdf.open(file_path) as pdf:
+        return pdf.page_count
+
+def _render_page_range(file_path: Path, start: int, end: int) -> List[bytes]:
+    """
+    Renders pages [start, end) to JPEG bytes in memory (no subprocess, no temp files).
+    Opens its own document, so it can run in any thread or worker process.
+    """
+    pages = []
+    with pymupdf.open(file_path) as pdf:
+        for i in range(start, end):
+            page = pdf[i]
+            # Page sizes are in points (1/72 in); large pages render at a lower dpi
+            dpi = min(PDF_RASTER_DPI, int(MAX_IMAGE_EDGE * 72 / max(page.rect.width, page.rect.height)))
+            pages.append(page.get_pixmap(dpi=dpi, alpha=False).tobytes("jpeg"))
+    return pages
+
+async def _load_pdf_pages(file_path: Path) -> List[types.Part]:
+    """
+    Rasterizes every page as a JPEG Part; the SDK would re-encode PIL images as PNG
+    before upload. Short PDFs render in a thread, longer ones in contiguous page
+    ranges across the process pool, merged back in page order.
+    """
+    page_count = await asyncio.to_thread(_pdf_page_count, file_path)
+    workers = RENDER_WORKERS
+    if page_count < PARALLEL_RENDER_MIN_PAGES or workers == 1:
+        pages = await asyncio.to_thread(_render_page_range, file_path, 0, page_count)
+    else:
+        loop = asyncio.get_running_loop()
+        step = -(-page_count // workers)
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(get_render_pool(), _render_page_range, file_path, start, min(start + step, page_count))
+            for start in range(0, page_count, step)
+        ))
+        pages = [page for chunk in chunks for page in chunk]
+    return [types.Part.from_bytes(data=page, mime_type="image/jpeg") for page in pages]
+
+# Documents with more pages are decided in ranges of this many pages, in parallel
+PAGES_PER_REQUEST = 5
+
+# Caps how many documents are rasterized at once, so a burst of uploads doesn't
+# occupy every worker thread (and core) at the same time
+render_semaphore = asyncio.Semaphore(settings.RENDER_CONCURRENCY)
+
+def _load_image(file_path: Path, mime_type: str) -> types.Part:
+    """
+    Sends the uploaded image bytes as-is when they fit MAX_IMAGE_EDGE (PIL only reads
+    the header); larger images are downscaled and re-encoded as JPEG once.
+    """
+    data = file_path.read_bytes()
+    with PIL.Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= MAX_IMAGE_EDGE:
+            return types.Part.from_bytes(data=data, mime_type=mime_type)
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), PIL.Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.convert("RGB").save(buffer, format="JPEG", quality=85)
+    return types.Part.from_bytes(data=buffer.getvalue(), mime_type="image/jpeg")
+
+async def _render_pages(file_path: Path, mime_type: str) -> List[types.Part]:
+    """Loads the pages Gemini sees for a PDF or image file, off the event loop."""
+    async with render_semaphore:
+        if mime_type == "application/pdf":
+            return await _load_pdf_pages(file_path)
+        return [await asyncio.to_thread(_load_image, file_path, mime_type)]
+
+async def upload_pages(client: genai.Client, pages: List[types.Part]) -> List[types.File]:
+    """
+    Uploads inline pages through the File API, concurrently. Reference the returned
+    files with Part.from_uri and remove them with delete_uploaded_files.
+    """
+    return list(await asyncio.gather(*(
+        client.aio.files.upload(
+            file=io.BytesIO(page.inline_data.data),
+            config=types.UploadFileConfig(mime_type=page.inline_data.mime_type),
+        )
+        for page in pages
+    )))
+
+async def delete_uploaded_files(client: genai.Client, files: List[types.File]):
+    """Deletes uploaded pages once decided; they would otherwise linger for 48 hours."""
+    results = await asyncio.gather(*(client.aio.files.delete(name=f.name) for f in files), return_exceptions=True)
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        print(f"Failed to delete {len(failed)} uploaded pages: {failed[0]}")
+
+def validate_decision(proposals: List[dict], context: dict) -> List[str]:
+    """Checks a decision's ids and types against the agent context; returns the errors to send back."""
+    validation_errors = []
+    
+    # Extract valid IDs from context
+    valid_account_ids = {a["id"] for a in context.get("accounts", [])}
+    valid_category_ids = {c["id"] for c in context.get("categories", [])}
+    valid_transaction_types = {"INCOME", "EXPENSE", "TRANSFER"}
+
+    for p in proposals:
+        p_type = p.get("type")
+        if p_type == "CREATE_ACCOUNT":
+            new_acc = p.get("new_account_data") or {}
+            if new_acc.get("type") not in ["ASSET", "LIABILITY"]:
+                validation_errors.append(f"Invalid account type '{new_acc.get('type')}' for account '{new_acc.get('name')}'. MUST be 'ASSET' or 'LIABILITY'.")
+            
+            for tx in p.get("transactions") or []:
+                if tx.get("type") not in valid_transaction_types:
+                    validation_errors.append(f"Invalid transaction type '{tx.get('type')}'. MUST be 'INCOME', 'EXPENSE', or 'TRANSFER'.")
+                if tx.get("category_id") and tx.get("category_id") not in valid_category_ids:
+                    validation_errors.append(f"Invalid category_id '{tx.get('category_id')}' for transaction with merchant '{tx.get('merchant')}'. This ID does not exist in your context. You MUST use one of the IDs from the categories list: {list(valid_category_ids)}. Do NOT use the category name.")
+        
+        elif p_type in ["CREATE_NEW", "UPDATE_EXISTING"]:
+            p_data = p.get("data") or {}
+            if p_data.get("account_id") and p_data.get("account_id") not in valid_account_ids:
+                validation_errors.append(f"Invalid account_id '{p_data.get('account_id')}'. This ID does not exist. Use a valid ID from the provided accounts list: {list(valid_account_ids)}.")
+            if p_data.get("category_id") and p_data.get("category_id") not in valid_category_ids:
+                validation_errors.append(f"Invalid category_id '{p_data.get('category_id')}' for merchant '{p_data.get('merchant')}'. This ID does not exist. You MUST use one of the IDs from the categories list: {list(valid_category_ids)}. Do NOT use the category name.")
+            if p_data.get("type") and p_data.get("type") not in valid_transaction_types:
+                validation_errors.append(f"Invalid transaction type '{p_data.get('type')}'. MUST be 'INCOME', 'EXPENSE', or 'TRANSFER'.")
+    return validation_errors
+
+def supports_tools_with_schema(model: str) -> bool:
+    """
+    Whether the model accepts function calling together with a JSON response schema.
+    Gemini 3 and later do; earlier models reject the request with a 400, so they are
+    sent the schema alone and decide from the transactions in the context.
+    """
+    match = re.match(r"(?:models/)?gemini-(\d+)", model)
+    return bool(match) and int(match.group(1)) >= 3
+
+async def decide_pages(client: genai.Client, prompt: List[str], pages: List[types.Part], context: dict,
+                       search_transactions, db: AsyncSession, db_lock: asyncio.Lock) -> Optional[List[dict]]:
+    """
+    Asks Gemini for the proposals covering `pages`, retrying with the validation errors
+    of each rejected decision. Returns None when no valid decision was made.
+    """
+    query_count = 0
+    limit = settings.GENAI_LIMIT_QUERY
+    history: List[str] = []
+    search_tool_supported = supports_tools_with_schema(settings.GOOGLE_GENAI_MODEL)
+
+    while query_count < limit:
+        print(f"Agentic Loop: Query {query_count + 1}/{limit}")
+
+        # Prepare multimodal content: Prompt + Images (+ History)
+        contents = [*prompt, *pages]
+        if history:
+            contents.append(f"History of your previous decisions and their validation errors:\n[{','.join(history)}]")
+
+        # End the read transaction so the session holds no pooled connection
+        # (nor, on SQLite, an old WAL snapshot) for the seconds the call takes
+        async with db_lock:
+            await db.commit()
+        print(f"Sending request to Gemini (Model: {settings.GOOGLE_GENAI_MODEL})...")
+        response = await generate_with_retry(
+            client,
+            model=settings.GOOGLE_GENAI_MODEL,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                thinking_config=types.ThinkingConfig(
+                    thinking_level=types.ThinkingLevel.MINIMAL,
+                ),
+                system_instruction=AGENT_INSTRUCTIONS,
+                response_mime_type='application/json',
+                response_schema=DocumentDecision,
+                # Searches run as function calls inside this one request instead of
+                # a full prompt round-trip per query (on models that allow it)
+                tools=[search_transactions] if search_tool_supported else None,
+                automatic_function_calling=types.AutomaticFunctionCallingConfig(
+                    maximum_remote_calls=limit,
+                ) if search_tool_supported else None,
+            )
+        )
+        usage = response.usage_metadata
+        print(f"Response received from Gemini ({getattr(usage, 'cached_content_token_count', None) or 0} cached prompt tokens).")
+
+        if not response.text or not response.text.strip():
+            return None
+
+        try:
+            res = orjson.loads(response.text)
+        except orjson.JSONDecodeError:
+            return None
+
+        if res.get("action") != "DECIDE":
+            return None
+
+        proposals = res.get("proposals", [])
+        print(f"Action: DECIDE - {len(proposals)} proposals")
+        validation_errors = validate_decision(proposals, context)
+        if not validation_errors:
+            return proposals
+
+        print(f"Validation Errors: {validation_errors}")
+        query_count += 1
+        history.append(orjson.dumps({
+            "decision": res,
+            "errors": validation_errors
+        }).decode())
+    return None
+
+def merge_decisions(decisions: List[List[dict]]) -> List[dict]:
+    """
+    Combines the proposals decided for consecutive page ranges, given in page order.
+    A new account proposed by several ranges (a statement spanning them) becomes one
+    proposal: transactions are concatenated in page order, the opening balance comes
+    from the first range that has one and the closing balance from the last range
+    that has one, as long as that range is not before the opening one.
+    """
+    merged, accounts = [], {}
+    for proposals in decisions:
+        for p in proposals:
+            new_account = p.get("new_account_data") or {}
+            key = str(new_account.get("name") or "").lower()
+            if p.get("type") != "CREATE_ACCOUNT" or not key:
+                merged.append(p)
+            elif key not in accounts:
+                accounts[key] = p
+                merged.append(p)
+            else:
+                first = accounts[key]
+                account = first["new_account_data"]
+                first["transactions"] = (first.get("transactions") or []) + (p.get("transactions") or [])
+                if account.get("opening_balance") is None and new_account.get("opening_balance") is not None:
+                    # A closing balance from pages before the opening one doesn't close this statement
+                    account["opening_balance"] = new_account["opening_balance"]
+                    account["closing_balance"] = new_account.get("closing_balance")
+                elif new_account.get("closing_balance") is not None:
+                    account["closing_balance"] = new_account["closing_balance"]
+                first["confidence"] = min(first.get("confidence") or 0.7, p.get("confidence") or 0.7)
+    return merged
 
 async def process_document_task(document_id: str):
     """
@@ -56,24 +431,23 @@ async def process_document_task(document_id: str):
         await db.commit()
 
         try:
+            # An identical file processed before gets its proposals without another Gemini call
+            if await copy_duplicate_proposals(db, doc):
+                print(f"Document {document_id} duplicates an earlier upload, reusing its proposals")
+                doc.status = "PROCESSED"
+                await db.commit()
+                return
+
             # 1. Prepare images
-            images = []
-            file_path = Path(doc.file_path)
-            
-            if doc.mime_type == "application/pdf":
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    converted_images = convert_from_path(file_path)
-                    for i, img in enumerate(converted_images):
-                        img_path = Path(temp_dir) / f"page_{i}.jpg"
-                        img.save(img_path, "JPEG")
-                        images.append(PIL.Image.open(img_path))
-            elif doc.mime_type.startswith("image/"):
-                images.append(PIL.Image.open(file_path))
-            else:
+            if doc.mime_type != "application/pdf" and not doc.mime_type.startswith("image/"):
                 doc.status = "ERROR"
                 await db.commit()
                 return
 
+            # Rasterizing and image decoding block, so they run in worker
+            # threads or processes and the event loop keeps serving requests
+            images = await _render_pages(Path(doc.file_path), doc.mime_type)
+
             if not images:
                 doc.status = "ERROR"
                 await db.commit()
@@ -81,187 +455,83 @@ async def process_document_task(document_id: str):
 
             # 2. Unified Agentic Loop
             print(f"Starting processing for document {document_id}")
-            client = genai.Client(api_key=settings.GOOGLE_GENAI_KEY)
+            client = get_genai_client()
             user_id = doc.user_id
             
             # Initial context (without merchant filtering yet, or we can do a broad one)
             context = await get_agent_context(db, user_id)
-            
-            query_count = 0
-            limit = settings.GENAI_LIMIT_QUERY
-            history = []
-
-            while query_count < limit:
-                print(f"Agentic Loop: Query {query_count + 1}/{limit}")
-                prompt = f"""
-                You are an intelligent accounting assistant. Your goal is to extract all transactions from the following document images
-                and decide whether they match existing ones, should be created individually, or part of a batch.
-
-                User Context (Accounts, Categories, and Recent Transactions):
-                {json.dumps(context, indent=2)}
-
-                History of your queries and results:
-                {json.dumps(history, indent=2)}
-
-                CRITICAL RULES:
-                1. Every transaction MUST have an `account_id` if it is a `CREATE_NEW` or `UPDATE_EXISTING`.
-                2. If the document clearly belongs to a specific account (e.g., a credit card statement) that is NOT in the context, propose `CREATE_ACCOUNT`.
-                3. If you cannot find a matching account in the context or suggestions, use the ID of the "Petty Cash Account".
-                4. CATEGORY MATCHING: You MUST use the `id` field from the provided categories list. DO NOT use the category name as an ID. If you cannot find a matching category, use the ID of the category most likely to fit.
-                5. ACCOUNT TYPES: When proposing `CREATE_ACCOUNT`, the `type` MUST be exactly 'ASSET' or 'LIABILITY'. Use `sub_type` for specific details (e.g., 'BANK', 'CREDIT_CARD', 'CASH', 'INVESTMENT').
-                6. BALANCES: For any document that looks like a statement (e.g., Bank, Credit Card, or Utility Statement), you MUST extract `opening_balance` and `closing_balance`. Include these at the top level of your `DECIDE` proposal data or inside `new_account_data`. This is CRITICAL for ledger reconciliation.
-                
-                Available Actions:
-                1. QUERY: If you need to search for more transactions to confirm a match.
-                   Example: {{"action": "QUERY", "params": {{"merchant": "Amazon", "amount": 25.00}}}}
-                2. DECIDE: Make a final proposal for the document. You can return multiple proposals.
-                   Decision Options for each item: 
-                   - "CREATE_NEW": No matching transaction found.
-                   - "UPDATE_EXISTING": Match found. Provide `target_transaction_id`.
-                   - "CREATE_ACCOUNT": If transactions belong to a NEW account. Provide `new_account_data` and the list of `transactions`.
-
-                   Return format for DECIDE:
-                   {{
-                     "action": "DECIDE",
-                     "proposals": [
-                       {{
-                         "type": "CREATE_NEW",
-                         "data": {{
-                            "amount": 10.50,
-                            "merchant": "Coffee Shop",
-                            "transaction_date": "2026-01-01",
-                            "type": "EXPENSE",
-                            "category_id": "cat_123",
-                            "account_id": "acc_456"
-                         }},
-                         "confidence": 0.9
-                       }},
-                       {{
-                         "type": "CREATE_ACCOUNT",
-                         "new_account_data": {{
-                            "name": "Human-readable name", 
-                            "type": "MANDATORY: MUST BE EITHER 'ASSET' OR 'LIABILITY'", 
-                            "sub_type": "Optional: e.g., 'BANK', 'SAVINGS', 'CREDIT_CARD', 'CASH'", 
-                            "description": "...",
-                            "opening_balance": 1500.25,
-                            "closing_balance": 1200.50
-                         }},
-                         "transactions": [{{
-                            "amount": 1000.0,
-                            "merchant": "Employer",
-                            "transaction_date": "2026-01-01",
-                            "type": "INCOME",
-                            "category_id": "MANDATORY: Use an ID from the context"
-                         }}],
-                         "confidence": 0.95
-                       }}
-                     ]
-                   }}
-
-                Return ONLY a JSON object.
-                """
-
-                # Prepare multimodal content: Prompt + Images
-                contents = [prompt]
-                for img in images:
-                    contents.append(img)
-
-                print(f"Sending request to Gemini (Model: {settings.GOOGLE_GENAI_MODEL})...")
-                await gemini_limiter.wait()
-                response = await client.aio.models.generate_content(
-                    model=settings.GOOGLE_GENAI_MODEL,
-                    contents=contents,
-                    config=types.GenerateContentConfig(
-                        thinking_config=types.ThinkingConfig(
-                            thinking_level=types.ThinkingLevel.MINIMAL,
-                        ),
-                        response_mime_type='application/json',
-                    )
-                )
-                print("Response received from Gemini.")
-
-                if not response.text or not response.text.strip():
-                    break
-
+            # Page ranges share this session, so their searches and commits take turns;
+            # they overlap on the Gemini calls, which is where the time goes
+            db_lock = asyncio.Lock()
+
+            async def search_transactions(
+                merchant: Optional[str] = None,
+                amount: Optional[float] = None,
+                start_date: Optional[str] = None,
+                end_date: Optional[str] = None,
+            ) -> List[dict]:
+                """Searches the user's existing transactions. Dates are ISO 8601 strings."""
+                params = {"merchant": merchant, "amount": amount, "start_date": start_date, "end_date": end_date}
+                print(f"Tool call: search_transactions - {params}")
+                async with db_lock:
+                    found = await search_transactions_logic(db, user_id, {k: v for k, v in params.items() if v is not None})
+                    # Hand the connection back while the model keeps generating
+                    await db.commit()
+                return found
+
+            # Identical on every attempt; only the history part appended after the images
+            # changes, so retries share the whole prompt and images as a cacheable prefix
+            prompt = CONTEXT_HEADER + orjson.dumps(context).decode()
+
+            # Short documents (a receipt, a one-page statement) are decided in one request.
+            # Longer ones are split into page ranges decided in parallel and merged; their
+            # pages are uploaded once through the File API before the first attempt, so
+            # every attempt of a range sends the same prefix of file references.
+            uploaded = []
+            if len(images) > PAGES_PER_REQUEST:
                 try:
-                    res = json.loads(response.text)
-                except json.JSONDecodeError:
-                    break
-
-                if res.get("action") == "QUERY":
-                    query_count += 1
-                    params = res.get("params", {})
-                    print(f"Action: QUERY - {params}")
-                    search_results = await search_transactions_logic(db, user_id, params)
-                    history.append({
-                        "query": params,
-                        "results": search_results
-                    })
-                    continue
-                elif res.get("action") == "DECIDE":
-                    proposals = res.get("proposals", [])
-                    print(f"Action: DECIDE - {len(proposals)} proposals")
-                    validation_errors = []
-                    
-                    # Extract valid IDs from context
-                    valid_account_ids = {a["id"] for a in context.get("accounts", [])}
-                    valid_category_ids = {c["id"] for c in context.get("categories", [])}
-                    valid_transaction_types = {"INCOME", "EXPENSE", "TRANSFER"}
-
-                    for p in proposals:
-                        p_type = p.get("type")
-                        if p_type == "CREATE_ACCOUNT":
-                            new_acc = p.get("new_account_data", {})
-                            if new_acc.get("type") not in ["ASSET", "LIABILITY"]:
-                                validation_errors.append(f"Invalid account type '{new_acc.get('type')}' for account '{new_acc.get('name')}'. MUST be 'ASSET' or 'LIABILITY'.")
-                            
-                            for tx in p.get("transactions", []):
-                                if tx.get("type") not in valid_transaction_types:
-                                    validation_errors.append(f"Invalid transaction type '{tx.get('type')}'. MUST be 'INCOME', 'EXPENSE', or 'TRANSFER'.")
-                                if tx.get("category_id") and tx.get("category_id") not in valid_category_ids:
-                                    validation_errors.append(f"Invalid category_id '{tx.get('category_id')}' for transaction with merchant '{tx.get('merchant')}'. This ID does not exist in your context. You MUST use one of the IDs from the categories list: {list(valid_category_ids)}. Do NOT use the category name.")
-                        
-                        elif p_type in ["CREATE_NEW", "UPDATE_EXISTING"]:
-                            p_data = p.get("data", {})
-                            if p_data.get("account_id") and p_data.get("account_id") not in valid_account_ids:
-                                validation_errors.append(f"Invalid account_id '{p_data.get('account_id')}'. This ID does not exist. Use a valid ID from the provided accounts list: {list(valid_account_ids)}.")
-                            if p_data.get("category_id") and p_data.get("category_id") not in valid_category_ids:
-                                validation_errors.append(f"Invalid category_id '{p_data.get('category_id')}' for merchant '{p_data.get('merchant')}'. This ID does not exist. You MUST use one of the IDs from the categories list: {list(valid_category_ids)}. Do NOT use the category name.")
-                            if p_data.get("type") and p_data.get("type") not in valid_transaction_types:
-                                validation_errors.append(f"Invalid transaction type '{p_data.get('type')}'. MUST be 'INCOME', 'EXPENSE', or 'TRANSFER'.")
-
-                    if validation_errors:
-                        print(f"Validation Errors: {validation_errors}")
-                        query_count += 1
-                        history.append({
-                            "decision": res,
-                            "errors": validation_errors
-                        })
-                        continue
-
-                    for p in proposals:
-                        p_type = p.get("type")
-                        p_data = p.get("data")
-                        p_confidence = p.get("confidence", 0.7)
-                        
-                        if p_type == "CREATE_ACCOUNT":
-                            batch_data = {
-                                "_new_account": p.get("new_account_data"),
-                                "transactions": p.get("transactions")
-                            }
-                            await apply_proposal(batch_data, doc, db, "CREATE_ACCOUNT", None, p_confidence)
-                        elif p_type == "UPDATE_EXISTING":
-                            await apply_proposal(p_data, doc, db, "UPDATE_EXISTING", p.get("target_transaction_id"), p_confidence)
-                        else:
-                            await apply_proposal(p_data, doc, db, "CREATE_NEW", None, p_confidence)
+                    uploaded = await upload_pages(client, images)
+                    images = [types.Part.from_uri(file_uri=f.uri, mime_type=f.mime_type) for f in uploaded]
+                except Exception as e:
+                    print(f"Page upload failed, sending pages inline: {str(e)}")
+            ranges = [images[i:i + PAGES_PER_REQUEST] for i in range(0, len(images), PAGES_PER_REQUEST)]
+            try:
+                decisions = await asyncio.gather(*(
+                    decide_pages(
+                        client,
+                        [prompt, f"Pages {i * PAGES_PER_REQUEST + 1}-{i * PAGES_PER_REQUEST + len(pages)} of {len(images)}."] if len(ranges) > 1 else [prompt],
+                        pages, context, search_transactions, db, db_lock,
+                    )
+                    for i, pages in enumerate(ranges)
+                ))
+            finally:
+                if uploaded:
+                    await delete_uploaded_files(client, uploaded)
+            proposals = merge_decisions([d for d in decisions if d is not None])
+
+            if proposals:
+                # One round of lookups for every proposal in the decision, one INSERT for all of them.
+                # The accounts and categories the decision was validated against are reused.
+                lookups = await load_proposal_lookups(db, doc, [p.get("data") for p in proposals], context)
+                rows = []
+                for p in proposals:
+                    p_type = p.get("type")
+                    p_data = p.get("data") or {}
+                    p_confidence = p.get("confidence", 0.7)
                     
-                    doc.status = "PROCESSED"
-                    await db.commit()
-                    return
-                else:
-                    break
-
-            # Fallback (optional, if DECIDE was never reached)
+                    if p_type == "CREATE_ACCOUNT":
+                        batch_data = {
+                            "_new_account": p.get("new_account_data"),
+                            "transactions": p.get("transactions") or []
+                        }
+                        rows.append(prepare_proposal(batch_data, doc, "CREATE_ACCOUNT", None, p_confidence, lookups))
+                    elif p_type == "UPDATE_EXISTING":
+                        rows.append(prepare_proposal(p_data, doc, "UPDATE_EXISTING", p.get("target_transaction_id"), p_confidence, lookups))
+                    else:
+                        rows.append(prepare_proposal(p_data, doc, "CREATE_NEW", None, p_confidence, lookups))
+                await save_proposals(db, rows)
+
+            # Also reached when no decision was made (empty or malformed answers)
             doc.status = "PROCESSED"
             await db.commit()
 
@@ -270,49 +540,47 @@ async def process_document_task(document_id: str):
             doc.status = "ERROR"
             await db.commit()
 
+# (user_id, merchants) -> agent context, shared by a user's documents processed in a
+# burst; dropped by invalidate_agent_context when accounts or categories change
+_context_cache: TTLCache = TTLCache(maxsize=256, ttl=30)
+
+def invalidate_agent_context(user_id: str):
+    for key in [key for key in _context_cache if key[0] == user_id]:
+        _context_cache.pop(key, None)
+
 async def get_agent_context(db: AsyncSession, user_id: str, relevant_merchants: Optional[List[str]] = None):
-    # Last transactions
-    q_t = select(Transaction).where(Transaction.user_id == user_id).order_by(desc(Transaction.transaction_date))
-    
-    # If we have relevant merchants, prioritize transactions from them
-    relevant_transactions: List[Transaction] = []
-    if relevant_merchants:
-        t_conditions = [Transaction.merchant.ilike(f"%{m}%") for m in relevant_merchants if m]
-        if t_conditions:
-            q_t_relevant = select(Transaction).where(Transaction.user_id == user_id, or_(*t_conditions)).limit(10)
-            res_t_rel = await db.execute(q_t_relevant)
-            relevant_transactions = list(res_t_rel.scalars().all())
-
-    res_t = await db.execute(q_t.limit(10))
-    recent_transactions = list(res_t.scalars().all())
-    
-    # Combine and deduplicate
-    all_context_transactions = {t.id: t for t in recent_transactions + relevant_transactions}.values()
-    
-    # All accounts
-    q_a = select(Account).where(Account.user_id == user_id)
-    res_a = await db.execute(q_a)
-    accounts = res_a.scalars().all()
-    
-    # All categories
-    q_c = select(Category).where(Category.user_id == user_id)
-    res_c = await db.execute(q_c)
-    categories = res_c.scalars().all()
-    
+    cache_key = (user_id, tuple(sorted(m for m in relevant_merchants or [] if m)))
+    cached = _context_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Last transactions, plus (when given) up to 10 from the relevant merchants, in one
+    # statement: UNION merges the two id lists and drops ids found by both
+    recent_ids = select(Transaction.id).where(Transaction.user_id == user_id).order_by(desc(Transaction.transaction_date)).limit(10)
+    id_selects = [select(recent_ids.subquery().c.id)]
+    t_conditions = [Transaction.merchant.ilike(f"%{m}%") for m in relevant_merchants or [] if m]
+    if t_conditions:
+        relevant_ids = select(Transaction.id).where(Transaction.user_id == user_id, or_(*t_conditions)).limit(10)
+        id_selects.append(select(relevant_ids.subquery().c.id))
+    q_t = select(Transaction).where(Transaction.id.in_(union(*id_selects))).order_by(desc(Transaction.transaction_date))
+
     # Filtered merchants
-    if relevant_merchants:
-        m_conditions = [Merchant.name.ilike(f"%{m}%") for m in relevant_merchants if m]
-        if m_conditions:
-            q_m = select(Merchant).where(Merchant.user_id == user_id, or_(*m_conditions))
-        else:
-            q_m = select(Merchant).where(Merchant.user_id == user_id).limit(20)
+    m_conditions = [Merchant.name_lower.like(f"%{m.lower()}%") for m in relevant_merchants or [] if m]
+    if m_conditions:
+        q_m = select(Merchant).where(Merchant.user_id == user_id, or_(*m_conditions))
     else:
         q_m = select(Merchant).where(Merchant.user_id == user_id).limit(20)
-        
-    res_m = await db.execute(q_m)
-    merchants = res_m.scalars().all()
-    
-    return {
+
+    # The four reads are independent, so they can run at the same time
+    all_context_transactions, accounts, categories, merchants = await fetch_all_concurrently(
+        db,
+        q_t,
+        select(Account).where(Account.user_id == user_id),
+        select(Category).where(Category.user_id == user_id),
+        q_m,
+    )
+
+    context = {
         "recent_transactions": [
             {
                 "id": t.id,
@@ -327,6 +595,30 @@ async def get_agent_context(db: AsyncSession, user_id: str, relevant_merchants:
         "categories": [{"id": c.id, "name": c.name, "type": c.type} for c in categories],
         "merchants": [{"id": m.id, "name": m.name, "default_category_id": m.default_category_id} for m in merchants]
     }
+    _context_cache[cache_key] = context
+    return context
+
+def _parse_iso_datetime(value) -> Optional[datetime]:
+    """
+    Parses an ISO 8601 date/datetime from model output to naive UTC, like the
+    stored transaction dates. Returns None when it is missing or malformed.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    return _parse_iso_string(value)
+
+# A statement repeats the same few dates across its lines; each string (malformed ones
+# included, so their ValueError is raised once) is parsed a single time
+@functools.lru_cache(maxsize=4096)
+def _parse_iso_string(value: str) -> Optional[datetime]:
+    try:
+        # fromisoformat accepts a trailing 'Z' since Python 3.11
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
 
 async def search_transactions_logic(db: AsyncSession, user_id: str, params: dict):
     query = select(Transaction).where(Transaction.user_id == user_id)
@@ -335,10 +627,12 @@ async def search_transactions_logic(db: AsyncSession, user_id: str, params: dict
         query = query.where(Transaction.merchant.ilike(f"%{params['merchant']}%"))
     if "amount" in params:
         query = query.where(Transaction.amount == float(params['amount']))
-    if "start_date" in params:
-        query = query.where(Transaction.transaction_date >= datetime.fromisoformat(params['start_date'].replace('Z', '+00:00')))
-    if "end_date" in params:
-        query = query.where(Transaction.transaction_date <= datetime.fromisoformat(params['end_date'].replace('Z', '+00:00')))
+    start_date = _parse_iso_datetime(params.get("start_date"))
+    if start_date:
+        query = query.where(Transaction.transaction_date >= start_date)
+    end_date = _parse_iso_datetime(params.get("end_date"))
+    if end_date:
+        query = query.where(Transaction.transaction_date <= end_date)
         
     res = await db.execute(query.limit(20))
     transactions = res.scalars().all()
@@ -353,45 +647,57 @@ async def search_transactions_logic(db: AsyncSession, user_id: str, params: dict
         } for t in transactions
     ]
 
-async def _get_petty_cash_account(db: AsyncSession, user_id: str) -> str:
+class ProposalLookups:
     """
-    Finds the 'Petty Cash Account' for the user.
-    It's expected to have been created during user registration.
+    Everything prepare_proposal validates against, loaded once per decision with one
+    query per table instead of several queries per proposal.
     """
-    query = select(Account).where(
-        Account.user_id == user_id,
-        Account.name == "Petty Cash Account"
-    )
-    result = await db.execute(query)
-    account = result.scalars().first()
-    
-    if not account:
-        # Fallback to any account if Petty Cash is missing for some reason
-        # (Though it should exist)
-        fallback_query = select(Account).where(Account.user_id == user_id).limit(1)
-        fallback_res = await db.execute(fallback_query)
-        account = fallback_res.scalars().first()
-        
-    if not account:
-        raise ValueError(f"No accounts found for user {user_id}")
-        
-    return account.id
+    def __init__(self, accounts: List[tuple], category_ids: set, merchant_categories: dict):
+        self.account_ids = {account_id for account_id, _ in accounts}
+        self.category_ids = category_ids
+        # merchant name_lower -> default_category_id
+        self.merchant_categories = merchant_categories
+        # The 'Petty Cash Account' created at registration, else any account
+        petty_cash = [account_id for account_id, name in accounts if name == "Petty Cash Account"]
+        self.petty_cash_account_id = (petty_cash or [account_id for account_id, _ in accounts] or [None])[0]
+
+async def load_proposal_lookups(db: AsyncSession, doc: Document, items: List[dict], context: Optional[dict] = None) -> ProposalLookups:
+    """
+    Loads the lookups for the proposal data dicts in `items` (3 queries at most).
+    Accounts and categories are taken from an agent `context` when one is given,
+    leaving only the merchant query.
+    """
+    if context is not None:
+        accounts = [(a["id"], a["name"]) for a in context["accounts"]]
+        category_ids = {c["id"] for c in context["categories"]}
+    else:
+        res_a = await db.execute(select(Account.id, Account.name).where(Account.user_id == doc.user_id))
+        res_c = await db.execute(select(Category.id).where(Category.user_id == doc.user_id))
+        accounts, category_ids = res_a.all(), set(res_c.scalars().all())
+
+    merchant_categories = {}
+    merchant_names = {str(item["merchant"]).lower() for item in items if item and item.get("merchant")}
+    if merchant_names:
+        res_m = await db.execute(
+            select(Merchant.name_lower, Merchant.default_category_id)
+            .where(Merchant.user_id == doc.user_id, Merchant.name_lower.in_(merchant_names))
+        )
+        for name_lower, default_category_id in res_m.all():
+            merchant_categories.setdefault(name_lower, default_category_id)
 
-async def _get_merchant_default_category(db: AsyncSession, user_id: str, merchant_name: str) -> Optional[str]:
+    return ProposalLookups(accounts, category_ids, merchant_categories)
+
+def _petty_cash_account_id(lookups: ProposalLookups, user_id: str) -> str:
     """
-    Looks up a merchant by name (case-insensitive) and returns its default category ID.
+    The user's 'Petty Cash Account'.
+    It's expected to have been created during user registration.
     """
-    if not merchant_name:
-        return None
-    query = select(Merchant).where(
-        Merchant.user_id == user_id,
-        Merchant.name.ilike(merchant_name)
-    )
-    result = await db.execute(query)
-    merchant = result.scalars().first()
-    return merchant.default_category_id if merchant else None
+    if not lookups.petty_cash_account_id:
+        raise ValueError(f"No accounts found for user {user_id}")
+    return lookups.petty_cash_account_id
 
-async def apply_proposal(data: dict, doc: Document, db: AsyncSession, change_type: str, target_id: Optional[str], confidence: float):
+def prepare_proposal(data: dict, doc: Document, change_type: str, target_id: Optional[str], confidence: float, lookups: ProposalLookups) -> dict:
+    """Validates and sanitizes a proposal's data; returns the ProposedChange row to save."""
     # Get merchant name for category lookup
     merchant_name = data.get("merchant")
 
@@ -399,29 +705,19 @@ async def apply_proposal(data: dict, doc: Document, db: AsyncSession, change_typ
     acc_id = data.get("account_id")
     if change_type == "CREATE_NEW":
         # Check if the account exists for this user
-        valid_acc = False
-        if acc_id:
-            res_a = await db.execute(select(Account).where(Account.id == acc_id, Account.user_id == doc.user_id))
-            if res_a.scalars().first():
-                valid_acc = True
-        
-        if not valid_acc:
+        if not acc_id or acc_id not in lookups.account_ids:
             # Default to Petty Cash if hallucinated or missing
-            data["account_id"] = await _get_petty_cash_account(db, doc.user_id)
+            data["account_id"] = _petty_cash_account_id(lookups, doc.user_id)
             
     # 2. Validate and suggest category if missing or hallucinated
     cat_id = data.get("category_id")
-    valid_cat = False
-    if cat_id:
-        res_c = await db.execute(select(Category).where(Category.id == cat_id, Category.user_id == doc.user_id))
-        if res_c.scalars().first():
-            valid_cat = True
+    valid_cat = bool(cat_id) and cat_id in lookups.category_ids
     
     if not valid_cat and merchant_name:
-        data["category_id"] = await _get_merchant_default_category(db, doc.user_id, str(merchant_name))
+        # Looks up the merchant by name (case-insensitive) for its default category
+        data["category_id"] = lookups.merchant_categories.get(str(merchant_name).lower())
     elif not valid_cat:
         data["category_id"] = None
-
     # 3. Sanitize transaction type
     tx_type = data.get("type", "EXPENSE")
     if tx_type not in ["INCOME", "EXPENSE", "TRANSFER"]:
@@ -444,59 +740,143 @@ async def apply_proposal(data: dict, doc: Document, db: AsyncSession, change_typ
                 acc_data["sub_type"] = acc_type
             acc_data["type"] = "ASSET"
 
-    # Check for existing proposal for this document and target
-    query_p = select(ProposedChange).where(
-        ProposedChange.document_id == doc.id,
-        ProposedChange.target_transaction_id == target_id
+    return dict(
+        user_id=doc.user_id,
+        document_id=doc.id,
+        target_transaction_id=target_id,
+        change_type=change_type,
+        proposed_data=data,
+        confidence_score=confidence,
+        status="PENDING"
     )
-    result_p = await db.execute(query_p)
-    existing_p = result_p.scalars().first()
-    
-    if existing_p:
-        existing_p.proposed_data = data
-        existing_p.confidence_score = confidence
-        existing_p.change_type = change_type
-    else:
-        proposal = ProposedChange(
+
+async def save_proposals(db: AsyncSession, rows: List[dict]):
+    """
+    Saves proposal rows with one INSERT ... ON CONFLICT (document_id, target_transaction_id)
+    DO UPDATE: a new proposal for a transaction with a pending proposal replaces it
+    atomically. Decided proposals are kept, and proposals without a target (new
+    transactions) never conflict.
+    """
+    # One statement cannot update the same row twice, so the last proposal per target wins here
+    by_target = {row["target_transaction_id"]: row for row in rows if row["target_transaction_id"]}
+    rows = [row for row in rows if not row["target_transaction_id"]] + list(by_target.values())
+    if not rows:
+        return
+    stmt = dialect_insert(db)(ProposedChange).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ProposedChange.document_id, ProposedChange.target_transaction_id],
+        index_where=PENDING_ONLY,
+        set_={
+            "proposed_data": stmt.excluded.proposed_data,
+            "confidence_score": stmt.excluded.confidence_score,
+            "change_type": stmt.excluded.change_type,
+        },
+    )
+    await db.execute(stmt)
+
+async def copy_duplicate_proposals(db: AsyncSession, doc: Document) -> bool:
+    """
+    Copies the proposals of the user's latest processed upload with the same content
+    hash. Only uploads whose proposals are all still pending qualify: once the user has
+    approved or rejected any of them, the file is decided again. The copy is also
+    skipped when a proposal refers to a transaction or account that no longer exists.
+    Returns whether proposals were copied.
+    """
+    if not doc.content_sha256:
+        return False
+    decided = select(ProposedChange.id).where(
+        ProposedChange.document_id == Document.id, ProposedChange.status != "PENDING"
+    ).exists()
+    source_id = (await db.execute(
+        select(Document.id)
+        .where(
+            Document.user_id == doc.user_id,
+            Document.content_sha256 == doc.content_sha256,
+            Document.id != doc.id,
+            Document.status == "PROCESSED",
+            ~decided,
+        )
+        .order_by(desc(Document.created_at))
+        .limit(1)
+    )).scalar()
+    if source_id is None:
+        return False
+
+    result = await db.execute(select(ProposedChange).where(ProposedChange.document_id == source_id))
+    proposals = result.scalars().all()
+    if not proposals:
+        return False
+
+    target_ids = {p.target_transaction_id for p in proposals if p.target_transaction_id}
+    account_ids = {
+        (p.proposed_data or {}).get(key) for p in proposals for key in ("account_id", "target_account_id")
+    } - {None}
+    found_targets, found_accounts = await fetch_all_concurrently(
+        db,
+        select(Transaction.id).where(Transaction.user_id == doc.user_id, Transaction.id.in_(target_ids)),
+        select(Account.id).where(Account.user_id == doc.user_id, Account.id.in_(account_ids)),
+    )
+    if len(found_targets) < len(target_ids) or len(found_accounts) < len(account_ids):
+        print(f"Proposals of duplicate document {source_id} refer to deleted rows; deciding again")
+        return False
+
+    await save_proposals(db, [
+        dict(
             user_id=doc.user_id,
             document_id=doc.id,
-            target_transaction_id=target_id,
-            change_type=change_type,
-            proposed_data=data,
-            confidence_score=confidence,
-            status="PENDING"
+            target_transaction_id=p.target_transaction_id,
+            change_type=p.change_type,
+            proposed_data=p.proposed_data,
+            confidence_score=p.confidence_score,
+            status="PENDING",
         )
-        db.add(proposal)
-
-async def fallback_matching_logic(data: dict, doc: Document, db: AsyncSession):
-    # Original matching logic as fallback
-    amount = float(data.get("amount", 0))
-    merchant = data.get("merchant", "")
-    date_str = data.get("transaction_date", "")
-    
-    try:
-        t_date = datetime.fromisoformat(date_str.replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
-    except:
-        t_date = datetime.now(timezone.utc)
+        for p in proposals
+    ])
+    return True
+
+def _within_a_day(transaction: Transaction, t_date: datetime) -> bool:
+    return abs((transaction.transaction_date - t_date).days) <= 1
+
+async def fallback_matching_logic(items: List[dict], doc: Document, db: AsyncSession):
+    # Original matching logic as fallback. All items are matched against one
+    # query over their amounts and date window instead of one query per item.
+    if not items:
+        return
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    dates = [_parse_iso_datetime(data.get("transaction_date")) or now for data in items]
+    amounts = {float(data.get("amount", 0)) for data in items}
 
     query = select(Transaction).where(
         Transaction.user_id == doc.user_id,
-        Transaction.amount == amount,
-        Transaction.merchant.ilike(f"%{merchant}%")
+        Transaction.amount.in_(amounts),
+        Transaction.transaction_date.between(min(dates) - timedelta(days=2), max(dates) + timedelta(days=2))
     )
     result = await db.execute(query)
-    existing_transactions = result.scalars().all()
-    
-    match = None
-    for et in existing_transactions:
-        if abs((et.transaction_date - t_date).days) <= 1:
-            match = et
-            break
-
-    change_type = "UPDATE_EXISTING" if match else "CREATE_NEW"
-    target_id = match.id if match else None
-    
-    if change_type == "CREATE_NEW" and not data.get("account_id"):
-        data["account_id"] = await _get_petty_cash_account(db, doc.user_id)
+    # Each candidate's merchant is lowercased once. An exact (amount, merchant) hit is a
+    # dict lookup; the substring scan only runs when there is no exact candidate.
+    by_amount, exact = {}, {}
+    for et in result.scalars().all():
+        merchant_lower = (et.merchant or "").lower()
+        by_amount.setdefault(et.amount, []).append((merchant_lower, et))
+        exact.setdefault((et.amount, merchant_lower), []).append(et)
+
+    lookups = await load_proposal_lookups(db, doc, items)
+    rows = []
+    for data, t_date in zip(items, dates):
+        amount = float(data.get("amount", 0))
+        merchant = str(data.get("merchant", "")).lower()
+        match = next((et for et in exact.get((amount, merchant), ()) if _within_a_day(et, t_date)), None)
+        if match is None:
+            match = next(
+                (et for name, et in by_amount.get(amount, ()) if merchant in name and _within_a_day(et, t_date)),
+                None
+            )
+
+        change_type = "UPDATE_EXISTING" if match else "CREATE_NEW"
+        target_id = match.id if match else None
         
-    await apply_proposal(data, doc, db, change_type, target_id, 0.7)
+        if change_type == "CREATE_NEW" and not data.get("account_id"):
+            data["account_id"] = _petty_cash_account_id(lookups, doc.user_id)
+            
+        rows.append(prepare_proposal(data, doc, change_type, target_id, 0.7, lookups))
+    await save_proposals(db, rows)
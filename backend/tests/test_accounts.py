@@ -92,3 +92,32 @@ async def test_update_account_not_found(client: AsyncClient, auth_headers: dict)
 async def test_delete_account_not_found(client: AsyncClient, auth_headers: dict):
     res = await client.delete("/accounts/non-existent", headers=auth_headers)
     assert res.status_code == 404
+
+@pytest.mark.asyncio
+async def test_update_account_other_user(client: AsyncClient, auth_headers: dict, auth_headers_other: dict):
+    create_res = await client.post(
+        "/accounts/",
+        json={"name": "Mine", "type": "ASSET"},
+        headers=auth_headers
+    )
+    acc_id = create_res.json()["id"]
+
+    res = await client.patch(f"/accounts/{acc_id}", json={"name": "Stolen"}, headers=auth_headers_other)
+    assert res.status_code == 404
+    res = await client.delete(f"/accounts/{acc_id}", headers=auth_headers_other)
+    assert res.status_code == 404
+
+@pytest.mark.asyncio
+async def test_large_list_is_gzipped(client: AsyncClient, auth_headers: dict):
+    for i in range(20):
+        await client.post(
+            "/accounts/",
+            json={"name": f"Account {i}", "type": "ASSET", "description": "x" * 50},
+            headers=auth_headers
+        )
+
+    response = await client.get("/accounts/", headers={**auth_headers, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert len(response.json()) == 21
@@ -24,3 +24,40 @@ async def test_get_current_user_missing_header(client: AsyncClient):
 async def test_get_current_user_empty_header(client: AsyncClient):
     res = await client.get("/accounts/", headers={settings.AUTH_EMAIL_HEADER: ""})
     assert res.status_code == 401
+
+@pytest.mark.asyncio
+async def test_get_current_user_cached(client: AsyncClient):
+    from backend.dependencies import _user_cache
+    email = "cached@example.com"
+    headers = {settings.AUTH_EMAIL_HEADER: email}
+    first = await client.get("/accounts/", headers=headers)
+    assert first.status_code == 200
+    assert email in _user_cache
+
+    # Cached lookups resolve to the same user without re-registering
+    second = await client.get("/accounts/", headers=headers)
+    assert second.status_code == 200
+    assert [a["id"] for a in second.json()] == [a["id"] for a in first.json()]
+
+@pytest.mark.asyncio
+async def test_get_current_user_stale_cache(client: AsyncClient):
+    from backend.dependencies import _user_cache
+    email = "stale@example.com"
+    _user_cache[email] = "no-longer-exists"
+    res = await client.get("/accounts/", headers={settings.AUTH_EMAIL_HEADER: email})
+    assert res.status_code == 200
+    assert len(res.json()) == 1
+    assert _user_cache[email] != "no-longer-exists"
+
+@pytest.mark.asyncio
+async def test_existing_user_not_blocked_by_registration(client: AsyncClient):
+    import asyncio
+    from backend.dependencies import _user_cache, _registration_locks
+    headers = {settings.AUTH_EMAIL_HEADER: "existing@example.com"}
+    first = await client.get("/accounts/", headers=headers)
+    _user_cache.pop("existing@example.com")
+
+    # Another email's registration in progress doesn't hold up this lookup
+    async with _registration_locks.setdefault("registering@example.com", asyncio.Lock()):
+        second = await asyncio.wait_for(client.get("/accounts/", headers=headers), timeout=5)
+    assert [a["id"] for a in second.json()] == [a["id"] for a in first.json()]
@@ -44,6 +44,23 @@ async def test_list_categories(client: AsyncClient, auth_headers: dict):
     assert response.status_code == 200
     assert any(c["name"] == "Salary" for c in response.json())
 
+@pytest.mark.asyncio
+async def test_list_categories_cursor_pagination(client: AsyncClient, auth_headers: dict):
+    # Registration creates the default categories
+    full = (await client.get("/categories/", headers=auth_headers)).json()
+
+    names, cursor = [], None
+    while True:
+        url = "/categories/?limit=3" + (f"&cursor={cursor}" if cursor else "")
+        response = await client.get(url, headers=auth_headers)
+        assert response.status_code == 200
+        names += [c["name"] for c in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert names == sorted(c["name"] for c in full)
+
 @pytest.mark.asyncio
 async def test_delete_category_not_found(client: AsyncClient, auth_headers: dict):
     res = await client.delete("/categories/non-existent", headers=auth_headers)
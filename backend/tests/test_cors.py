@@ -15,15 +15,15 @@ def test_cors_disabled_by_default():
             "Access-Control-Request-Method": "GET",
         },
     )
-    assert response.status_code == 200
+    assert response.status_code == 204
     # Should NOT have CORS headers because middleware didn't run
     assert "access-control-allow-origin" not in response.headers
 
 def test_options_method_supported_on_endpoints():
     # Test OPTIONS on a root endpoint
     response = client.options("/")
-    assert response.status_code == 200
+    assert response.status_code == 204
     
     # Test OPTIONS on an API endpoint
     response = client.options("/accounts/")
-    assert response.status_code == 200
+    assert response.status_code == 204
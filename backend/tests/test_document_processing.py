@@ -1,8 +1,10 @@
+import hashlib
 import pytest
 from unittest.mock import patch, MagicMock, AsyncMock
 from fastapi import UploadFile
 from backend.routers.documents import upload_document
 from backend.models import User, Document
+from backend.dependencies import AuthedSession
 
 @pytest.mark.asyncio
 async def test_upload_document_triggers_background_task():
@@ -10,7 +12,7 @@ async def test_upload_document_triggers_background_task():
     mock_file = MagicMock(spec=UploadFile)
     mock_file.filename = "test.pdf"
     mock_file.content_type = "application/pdf"
-    mock_file.file = MagicMock()
+    mock_file.read = AsyncMock(side_effect=[b"%PDF-1.4", b""])
     
     mock_db = MagicMock()
     mock_user = MagicMock(spec=User)
@@ -18,8 +20,13 @@ async def test_upload_document_triggers_background_task():
     
     mock_background_tasks = MagicMock()
     
-    with patch("backend.routers.documents.open", MagicMock()), \
-         patch("backend.routers.documents.shutil.copyfileobj", MagicMock()), \
+    mock_buffer = MagicMock()
+    mock_buffer.write = AsyncMock()
+    mock_open = MagicMock()
+    mock_open.return_value.__aenter__ = AsyncMock(return_value=mock_buffer)
+    mock_open.return_value.__aexit__ = AsyncMock(return_value=False)
+    
+    with patch("backend.routers.documents.aiofiles.open", mock_open), \
          patch("backend.routers.documents.process_document_task") as mock_task:
         
         # We need to mock the db.add, db.commit, db.refresh
@@ -32,10 +39,12 @@ async def test_upload_document_triggers_background_task():
             file=mock_file,
             user_note="Test note",
             background_tasks=mock_background_tasks,
-            db=mock_db,
-            current_user=mock_user
+            ctx=AuthedSession(mock_db, mock_user)
         )
         
+        mock_buffer.write.assert_awaited_once_with(b"%PDF-1.4")
+        saved = mock_db.add.call_args.args[0]
+        assert saved.content_sha256 == hashlib.sha256(b"%PDF-1.4").hexdigest()
         mock_background_tasks.add_task.assert_called_once()
         args, _ = mock_background_tasks.add_task.call_args
         assert args[0] == mock_task
@@ -2,9 +2,103 @@ import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
 from pathlib import Path
 import json
+import pymupdf
 from backend.services.document_processor import process_document_task
 from backend.models import Document, User, ProposedChange, Account, Category, Merchant
 from sqlalchemy import select
+from backend.services.document_processor import get_genai_client, DocumentDecision, AGENT_INSTRUCTIONS
+
+@pytest.fixture(autouse=True)
+def fresh_genai_client():
+    # Each test patches genai.Client; drop the client cached by an earlier test
+    get_genai_client.cache_clear()
+    yield
+    get_genai_client.cache_clear()
+
+def _write_pdf(path, page_count):
+    with pymupdf.open() as pdf:
+        for i in range(page_count):
+            pdf.new_page().insert_text((72, 72), f"Page {i + 1}")
+        pdf.save(path)
+
+@pytest.mark.asyncio
+async def test_load_pdf_pages_renders_jpeg_parts(tmp_path):
+    from backend.services.document_processor import _load_pdf_pages
+
+    path = tmp_path / "statement.pdf"
+    _write_pdf(path, 2)
+
+    pages = await _load_pdf_pages(path)
+    assert len(pages) == 2
+    assert all(p.inline_data.mime_type == "image/jpeg" for p in pages)
+    assert all(p.inline_data.data[:2] == b"\xff\xd8" for p in pages)
+
+@pytest.mark.asyncio
+async def test_load_pdf_pages_parallel_keeps_page_order(tmp_path, monkeypatch):
+    from backend.services import document_processor
+    from backend.services.document_processor import _load_pdf_pages, _render_page_range
+
+    path = tmp_path / "statement.pdf"
+    _write_pdf(path, 5)
+    monkeypatch.setattr(document_processor, "PARALLEL_RENDER_MIN_PAGES", 1)
+    monkeypatch.setattr(document_processor, "RENDER_WORKERS", 2)
+
+    pages = await _load_pdf_pages(path)
+    assert [p.inline_data.data for p in pages] == _render_page_range(path, 0, 5)
+
+@pytest.mark.asyncio
+async def test_render_pages_passes_image_bytes_through(tmp_path):
+    import PIL.Image
+    from backend.services.document_processor import _render_pages
+
+    path = tmp_path / "receipt.png"
+    PIL.Image.new("RGB", (800, 600), "white").save(path)
+
+    [part] = await _render_pages(path, "image/png")
+    assert part.inline_data.data == path.read_bytes()
+    assert part.inline_data.mime_type == "image/png"
+
+def test_pdf_render_size_follows_settings(tmp_path, monkeypatch):
+    import io
+    import PIL.Image
+    from backend.services import document_processor
+    from backend.services.document_processor import _render_page_range
+
+    path = tmp_path / "letter.pdf"
+    with pymupdf.open() as pdf:
+        pdf.new_page(width=612, height=792)  # Letter, in points
+        pdf.save(path)
+
+    def longest_edge():
+        [page] = _render_page_range(path, 0, 1)
+        return max(PIL.Image.open(io.BytesIO(page)).size)
+
+    # The default edge cap, not the DPI, limits a Letter page
+    assert 1500 < longest_edge() <= document_processor.MAX_IMAGE_EDGE
+    monkeypatch.setattr(document_processor, "MAX_IMAGE_EDGE", 2200)
+    assert longest_edge() == 1650  # 11 in at 150 dpi
+    monkeypatch.setattr(document_processor, "PDF_RASTER_DPI", 72)
+    assert longest_edge() == 792
+
+@pytest.mark.asyncio
+async def test_render_pages_caps_resolution(tmp_path):
+    import io
+    import PIL.Image
+    from backend.services.document_processor import _render_pages, MAX_IMAGE_EDGE
+
+    image_path = tmp_path / "receipt.png"
+    PIL.Image.new("RGB", (4000, 3000), "white").save(image_path)
+    pdf_path = tmp_path / "poster.pdf"
+    with pymupdf.open() as pdf:
+        pdf.new_page(width=2000, height=3000)
+        pdf.save(pdf_path)
+
+    [image] = await _render_pages(image_path, "image/png")
+    [page] = await _render_pages(pdf_path, "application/pdf")
+
+    assert image.inline_data.mime_type == "image/jpeg"
+    for part in (image, page):
+        assert max(PIL.Image.open(io.BytesIO(part.inline_data.data)).size) <= MAX_IMAGE_EDGE
 
 @pytest.mark.asyncio
 async def test_process_document_task_pdf(db_session, auth_headers):
@@ -32,14 +126,11 @@ async def test_process_document_task_pdf(db_session, auth_headers):
 
     # 2. Mocks
     mock_images = [MagicMock(), MagicMock()]
-    mock_images[0].save = MagicMock()
-    mock_images[1].save = MagicMock()
     
     # Mock return text from Gemini
     mock_gemini_json = '[{"amount": 100.0, "merchant": "Test Shop", "transaction_date": "2026-01-01", "type": "EXPENSE"}]'
     
-    with patch("backend.services.document_processor.convert_from_path", return_value=mock_images) as mock_pdf_conv, \
-         patch("backend.services.document_processor.PIL.Image.open", return_value=mock_images[0]) as mock_img_open, \
+    with patch("backend.services.document_processor._load_pdf_pages", return_value=mock_images) as mock_pdf_conv, \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -69,7 +160,10 @@ async def test_process_document_task_pdf(db_session, auth_headers):
         
         # 4. Verifications
         assert mock_pdf_conv.called
-        assert mock_client.aio.models.generate_content.called
+        assert mock_client.aio.models.generate_content.call_count == 1
+        config = mock_client.aio.models.generate_content.call_args.kwargs["config"]
+        assert config.response_schema is DocumentDecision
+        assert config.system_instruction == AGENT_INSTRUCTIONS
         
         # Verify status updated
         await db_session.refresh(doc)
@@ -124,7 +218,7 @@ async def test_process_document_task_gemini_error(db_session):
     db_session.add(doc)
     await db_session.commit()
 
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -136,6 +230,59 @@ async def test_process_document_task_gemini_error(db_session):
         await db_session.refresh(doc)
         assert doc.status == "ERROR"
 
+@pytest.mark.asyncio
+async def test_rate_limiter_sliding_window():
+    from backend.services.document_processor import RateLimiter
+
+    limiter = RateLimiter(2)
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        limiter.calls.popleft()  # the oldest call leaves the window
+
+    with patch("backend.services.document_processor.asyncio.sleep", new=fake_sleep):
+        await limiter.wait()
+        await limiter.wait()
+        assert delays == []  # under the limit: no waiting between calls
+        await limiter.wait()
+
+    assert len(delays) == 1 and 0 < delays[0] <= RateLimiter.WINDOW
+    assert len(limiter.calls) == 2
+
+def test_search_tool_only_offered_to_models_accepting_it_with_a_schema():
+    from backend.services.document_processor import supports_tools_with_schema
+
+    assert supports_tools_with_schema("gemini-3-flash-preview")
+    assert supports_tools_with_schema("models/gemini-3-pro")
+    assert not supports_tools_with_schema("gemini-2.5-flash")
+    assert not supports_tools_with_schema("gemini-2.0-flash-exp")
+
+@pytest.mark.asyncio
+async def test_generate_with_retry_backs_off_on_quota_errors(monkeypatch):
+    from google.genai import errors
+    from backend.services.document_processor import generate_with_retry, gemini_limiter, GEMINI_MAX_ATTEMPTS
+
+    monkeypatch.setattr(gemini_limiter, "wait", AsyncMock())
+
+    quota = errors.ClientError(429, {"error": {"message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+    client = MagicMock()
+    client.aio.models.generate_content = AsyncMock(side_effect=[quota, quota, "ok"])
+    with patch("backend.services.document_processor.asyncio.sleep", new=AsyncMock()) as sleep:
+        assert await generate_with_retry(client, model="m", contents=[]) == "ok"
+    assert [c.args[0] for c in sleep.call_args_list] == [1, 2]
+
+    # Other client errors fail at once; quota errors once the attempts run out
+    client.aio.models.generate_content = AsyncMock(side_effect=errors.ClientError(400, {"error": {"message": "bad"}}))
+    with pytest.raises(errors.ClientError):
+        await generate_with_retry(client, model="m", contents=[])
+    assert client.aio.models.generate_content.call_count == 1
+
+    client.aio.models.generate_content = AsyncMock(side_effect=quota)
+    with patch("backend.services.document_processor.asyncio.sleep", new=AsyncMock()), pytest.raises(errors.ClientError):
+        await generate_with_retry(client, model="m", contents=[])
+    assert client.aio.models.generate_content.call_count == GEMINI_MAX_ATTEMPTS
+
 @pytest.mark.asyncio
 async def test_process_document_task_batch(db_session, auth_headers):
     # Setup
@@ -152,7 +299,7 @@ async def test_process_document_task_batch(db_session, auth_headers):
     
     await db_session.commit()
 
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -204,7 +351,7 @@ async def test_petty_cash_account_reuse(db_session):
     db_session.add(doc)
     await db_session.commit()
     
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -256,7 +403,7 @@ async def test_category_suggestion_via_merchant(db_session):
     db_session.add(doc)
     await db_session.commit()
     
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -297,7 +444,7 @@ async def test_process_document_task_suggest_account(db_session, auth_headers):
     db_session.add(doc)
     await db_session.commit()
 
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -332,6 +479,182 @@ async def test_process_document_task_suggest_account(db_session, auth_headers):
         assert proposals[0].change_type == "CREATE_ACCOUNT"
         assert proposals[0].proposed_data["_new_account"]["name"] == "New Salary Account"
 
+@pytest.mark.asyncio
+async def test_process_document_task_null_optional_fields(db_session):
+    user = User(email="nulls@example.com", full_name="Nulls User")
+    db_session.add(user)
+    await db_session.flush()
+    db_session.add(Account(user_id=user.id, name="Petty Cash Account", type="ASSET"))
+    doc = Document(user_id=user.id, original_filename="r.jpg", file_path="/tmp/r.jpg", mime_type="image/jpeg")
+    db_session.add(doc)
+    await db_session.commit()
+
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
+         patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
+         patch("backend.services.document_processor.SessionLocal") as mock_session_local:
+        mock_session_local.return_value.__aenter__.return_value = db_session
+        mock_client = MagicMock()
+        mock_genai_client_class.return_value = mock_client
+        # Structured output sends unset Optional fields as explicit nulls
+        mock_res = MagicMock()
+        mock_res.text = json.dumps({
+            "action": "DECIDE",
+            "proposals": [
+                {"type": "CREATE_NEW", "data": None, "new_account_data": None, "transactions": None, "confidence": None},
+                {"type": "CREATE_ACCOUNT", "data": None, "new_account_data": {"name": "Card", "type": "LIABILITY"},
+                 "transactions": None, "confidence": 0.9},
+            ]
+        })
+        mock_client.aio.models.generate_content = AsyncMock(return_value=mock_res)
+
+        await process_document_task(doc.id)
+
+    await db_session.refresh(doc)
+    assert doc.status == "PROCESSED"
+    res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == doc.id))
+    assert sorted(p.change_type for p in res.scalars().all()) == ["CREATE_ACCOUNT", "CREATE_NEW"]
+
+@pytest.mark.asyncio
+async def test_process_document_task_long_document_split_into_page_ranges(db_session, tmp_path):
+    user = User(email="long_statement@example.com", full_name="Long Statement User")
+    db_session.add(user)
+    await db_session.flush()
+
+    pdf_path = tmp_path / "statement.pdf"
+    _write_pdf(str(pdf_path), 7)
+    doc = Document(user_id=user.id, original_filename="statement.pdf", file_path=str(pdf_path), mime_type="application/pdf")
+    db_session.add(doc)
+    await db_session.commit()
+
+    def decision(contents, **kwargs):
+        # Each page range sees the same account and reports its own part of the statement
+        first_range = "Pages 1-5 of 7." in contents
+        res = MagicMock()
+        res.text = json.dumps({
+            "action": "DECIDE",
+            "proposals": [{
+                "type": "CREATE_ACCOUNT",
+                "new_account_data": {
+                    "name": "Checking", "type": "ASSET",
+                    "opening_balance": 100.0 if first_range else None,
+                    "closing_balance": 80.0 if first_range else 50.0,
+                },
+                "transactions": [{
+                    "amount": 20.0 if first_range else 30.0,
+                    "merchant": "Shop A" if first_range else "Shop B",
+                    "transaction_date": "2026-01-01", "type": "EXPENSE",
+                }],
+                "confidence": 0.9 if first_range else 0.8,
+            }]
+        })
+        return res
+
+    with patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
+         patch("backend.services.document_processor.SessionLocal") as mock_session_local:
+        mock_session_local.return_value.__aenter__.return_value = db_session
+        mock_client = MagicMock()
+        mock_genai_client_class.return_value = mock_client
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=decision)
+        from google.genai import types
+        uploads = iter(range(7))
+
+        async def upload(file, config):
+            i = next(uploads)
+            return types.File(name=f"files/page-{i}", uri=f"files/page-{i}", mime_type="image/jpeg")
+        mock_client.aio.files.upload = AsyncMock(side_effect=upload)
+        mock_client.aio.files.delete = AsyncMock()
+
+        await process_document_task(doc.id)
+
+        calls = mock_client.aio.models.generate_content.call_args_list
+        assert len(calls) == 2
+        assert sorted(len(c.kwargs["contents"]) - 2 for c in calls) == [2, 5]
+        # Pages were uploaded once, referenced by every range, and removed afterwards
+        assert all(part.file_data.file_uri.startswith("files/page-") for c in calls for part in c.kwargs["contents"][2:])
+        assert sorted(c.kwargs["name"] for c in mock_client.aio.files.delete.call_args_list) == [f"files/page-{i}" for i in range(7)]
+
+    res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == doc.id))
+    proposals = res.scalars().all()
+    assert len(proposals) == 1
+    data = proposals[0].proposed_data
+    assert data["_new_account"]["opening_balance"] == 100.0
+    assert data["_new_account"]["closing_balance"] == 50.0
+    assert [t["merchant"] for t in data["transactions"]] == ["Shop A", "Shop B"]
+    assert proposals[0].confidence_score == 0.8
+
+@pytest.mark.asyncio
+async def test_process_document_task_retried_range_merges_in_page_order(db_session, tmp_path):
+    user = User(email="retried_range@example.com", full_name="Retried Range User")
+    db_session.add(user)
+    await db_session.flush()
+
+    pdf_path = tmp_path / "statement.pdf"
+    _write_pdf(str(pdf_path), 7)
+    doc = Document(user_id=user.id, original_filename="statement.pdf", file_path=str(pdf_path), mime_type="application/pdf")
+    db_session.add(doc)
+    await db_session.commit()
+
+    def decision(contents, **kwargs):
+        first_range = "Pages 1-5 of 7." in contents
+        # The second range is rejected once (invalid account type) and corrected on retry
+        retried = any(isinstance(c, str) and c.startswith("History") for c in contents)
+        res = MagicMock()
+        res.text = json.dumps({
+            "action": "DECIDE",
+            "proposals": [{
+                "type": "CREATE_ACCOUNT",
+                "new_account_data": {
+                    "name": "Checking", "type": "ASSET" if first_range or retried else "BANK",
+                    "opening_balance": 100.0 if first_range else None,
+                    "closing_balance": 80.0 if first_range else 50.0,
+                },
+                "transactions": [{
+                    "amount": 20.0 if first_range else 30.0,
+                    "merchant": "Shop A" if first_range else "Shop B",
+                    "transaction_date": "2026-01-01", "type": "EXPENSE",
+                }],
+                "confidence": 0.9,
+            }]
+        })
+        return res
+
+    with patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
+         patch("backend.services.document_processor.SessionLocal") as mock_session_local:
+        mock_session_local.return_value.__aenter__.return_value = db_session
+        mock_client = MagicMock()
+        mock_genai_client_class.return_value = mock_client
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=decision)
+        mock_client.aio.files.upload = AsyncMock(side_effect=Exception("offline"))
+
+        await process_document_task(doc.id)
+
+        calls = mock_client.aio.models.generate_content.call_args_list
+        assert [c.kwargs["contents"][1] for c in calls].count("Pages 6-7 of 7.") == 2
+
+    res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == doc.id))
+    [proposal] = res.scalars().all()
+    data = proposal.proposed_data
+    assert data["_new_account"]["type"] == "ASSET"
+    assert (data["_new_account"]["opening_balance"], data["_new_account"]["closing_balance"]) == (100.0, 50.0)
+    assert [t["merchant"] for t in data["transactions"]] == ["Shop A", "Shop B"]
+
+def test_merge_decisions_balances_from_non_adjacent_ranges():
+    from backend.services.document_processor import merge_decisions
+
+    def account(opening=None, closing=None, merchant="Shop"):
+        return [{"type": "CREATE_ACCOUNT", "confidence": 0.9,
+                 "new_account_data": {"name": "Checking", "type": "ASSET", "opening_balance": opening, "closing_balance": closing},
+                 "transactions": [{"merchant": merchant}]}]
+
+    # Opening on the first range, closing on the third; the middle one reports neither
+    [merged] = merge_decisions([account(100.0, 90.0, "A"), account(merchant="B"), account(closing=40.0, merchant="C")])
+    assert (merged["new_account_data"]["opening_balance"], merged["new_account_data"]["closing_balance"]) == (100.0, 40.0)
+    assert [t["merchant"] for t in merged["transactions"]] == ["A", "B", "C"]
+
+    # A closing balance from pages before the opening one is dropped
+    [merged] = merge_decisions([account(closing=70.0), account(opening=100.0), account()])
+    assert (merged["new_account_data"]["opening_balance"], merged["new_account_data"]["closing_balance"]) == (100.0, None)
+
 @pytest.mark.asyncio
 async def test_process_document_task_agentic_retry_invalid_type(db_session):
     # Setup
@@ -343,14 +666,16 @@ async def test_process_document_task_agentic_retry_invalid_type(db_session):
     db_session.add(doc)
     await db_session.commit()
 
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    from google.genai import types
+    page = types.Part.from_bytes(data=b"jpeg", mime_type="image/jpeg")
+
+    with patch("backend.services.document_processor._load_image", return_value=page), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
         mock_session_local.return_value.__aenter__.return_value = db_session
         mock_client = MagicMock()
         mock_genai_client_class.return_value = mock_client
-        
         # 1. Invalid DECIDE (type=BANK)
         mock_res_invalid = MagicMock()
         mock_res_invalid.text = json.dumps({
@@ -385,6 +710,12 @@ async def test_process_document_task_agentic_retry_invalid_type(db_session):
         
         # Verify result
         assert mock_client.aio.models.generate_content.call_count == 2
+        # The retry repeats the prompt and page as a cacheable prefix and appends the errors
+        first, retry = (c.kwargs["contents"] for c in mock_client.aio.models.generate_content.call_args_list)
+        assert first[1] is page
+        assert retry[:2] == first
+        assert not mock_client.aio.files.upload.called
+        assert "Invalid account type 'BANK'" in retry[-1]
         res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == doc.id))
         proposal = res.scalars().first()
         assert proposal.proposed_data["_new_account"]["type"] == "ASSET"
@@ -405,7 +736,7 @@ async def test_process_document_task_hallucinated_account_id(db_session):
     db_session.add(petty_acc)
     await db_session.commit()
 
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -471,7 +802,7 @@ async def test_process_document_task_hallucinated_category_id(db_session):
     db_session.add(petty_acc)
     await db_session.commit()
 
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -530,7 +861,7 @@ async def test_process_document_task_invalid_types_fallback(db_session):
     db_session.add(petty_acc)
     await db_session.commit()
 
-    with patch("backend.services.document_processor.PIL.Image.open", return_value=MagicMock()), \
+    with patch("backend.services.document_processor._load_image", return_value=MagicMock()), \
          patch("backend.services.document_processor.genai.Client") as mock_genai_client_class, \
          patch("backend.services.document_processor.SessionLocal") as mock_session_local:
         
@@ -574,3 +905,212 @@ async def test_process_document_task_invalid_types_fallback(db_session):
         proposal = res_p.scalars().first()
         assert proposal.proposed_data["type"] == "INCOME"
 
+
+@pytest.mark.asyncio
+async def test_fallback_matching_batches_items(db_session):
+    from datetime import datetime
+    from backend.database import count_queries
+    from backend.models import Transaction
+    from backend.services.document_processor import fallback_matching_logic
+
+    user = User(email="fallback@example.com", full_name="Fallback User")
+    db_session.add(user)
+    await db_session.flush()
+
+    acc = Account(user_id=user.id, name="Petty Cash Account", type="ASSET")
+    db_session.add(acc)
+    await db_session.flush()
+    existing = Transaction(user_id=user.id, account_id=acc.id, amount=12.5, type="EXPENSE",
+                           merchant="Corner Cafe", transaction_date=datetime(2026, 1, 2))
+    doc = Document(user_id=user.id, original_filename="test.jpg", file_path="/tmp/test.jpg", mime_type="image/jpeg")
+    db_session.add_all([existing, doc])
+    await db_session.commit()
+
+    items = [
+        {"amount": 12.5, "merchant": "cafe", "transaction_date": "2026-01-03T00:00:00Z", "type": "EXPENSE"},
+        {"amount": 99.0, "merchant": "Other", "transaction_date": "2026-01-03", "type": "EXPENSE"},
+        {"amount": 12.5, "merchant": "Cafe", "transaction_date": "2026-02-20", "type": "EXPENSE"},
+    ]
+    with count_queries() as queries:
+        await fallback_matching_logic(items, doc, db_session)
+        await db_session.flush()
+
+    # 1 match query, 3 lookup queries and 1 INSERT for all proposals
+    assert queries.count <= 5
+    res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == doc.id))
+    proposals = res.scalars().all()
+    assert sorted(p.change_type for p in proposals) == ["CREATE_NEW", "CREATE_NEW", "UPDATE_EXISTING"]
+    assert next(p for p in proposals if p.change_type == "UPDATE_EXISTING").target_transaction_id == existing.id
+    assert all(p.proposed_data["account_id"] == acc.id for p in proposals if p.change_type == "CREATE_NEW")
+
+@pytest.mark.asyncio
+async def test_save_proposals_upserts_by_target(db_session):
+    from datetime import datetime
+    from backend.models import Transaction
+    from backend.services.document_processor import save_proposals
+
+    user = User(email="upsert@example.com", full_name="Upsert User")
+    db_session.add(user)
+    await db_session.flush()
+    acc = Account(user_id=user.id, name="Checking", type="ASSET")
+    db_session.add(acc)
+    await db_session.flush()
+    tx = Transaction(user_id=user.id, account_id=acc.id, amount=5.0, type="EXPENSE", transaction_date=datetime(2026, 1, 1))
+    doc = Document(user_id=user.id, original_filename="test.jpg", file_path="/tmp/test.jpg", mime_type="image/jpeg")
+    db_session.add_all([tx, doc])
+    await db_session.commit()
+
+    def row(target_id, amount):
+        return dict(user_id=user.id, document_id=doc.id, target_transaction_id=target_id, change_type="UPDATE_EXISTING" if target_id else "CREATE_NEW",
+                    proposed_data={"amount": amount}, confidence_score=0.8, status="PENDING")
+
+    await save_proposals(db_session, [row(tx.id, 1.0), row(None, 2.0), row(None, 3.0)])
+    await save_proposals(db_session, [row(tx.id, 4.0)])
+
+    res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == doc.id))
+    proposals = res.scalars().all()
+    assert len(proposals) == 3
+    assert len({p.id for p in proposals}) == 3
+    updated = next(p for p in proposals if p.target_transaction_id == tx.id)
+    assert updated.proposed_data == {"amount": 4.0}
+
+    # A decided proposal is history: the next proposal for its target is a new row
+    updated.status = "APPROVED"
+    await db_session.commit()
+    await save_proposals(db_session, [row(tx.id, 6.0)])
+    res = await db_session.execute(select(ProposedChange.proposed_data).where(ProposedChange.target_transaction_id == tx.id))
+    assert sorted(d["amount"] for d in res.scalars()) == [4.0, 6.0]
+
+@pytest.mark.asyncio
+async def test_agent_context_merges_recent_and_relevant_transactions(db_session):
+    from datetime import datetime
+    from backend.database import count_queries
+    from backend.models import Transaction
+    from backend.services.document_processor import get_agent_context
+
+    user = User(email="context@example.com", full_name="Context User")
+    db_session.add(user)
+    await db_session.flush()
+    acc = Account(user_id=user.id, name="Checking", type="ASSET")
+    db_session.add(acc)
+    await db_session.flush()
+    old = Transaction(user_id=user.id, account_id=acc.id, amount=4.0, type="EXPENSE",
+                      merchant="Corner Cafe", transaction_date=datetime(2025, 1, 1))
+    recent = [
+        Transaction(user_id=user.id, account_id=acc.id, amount=float(i), type="EXPENSE",
+                    merchant="Grocer" if i else "Corner Cafe", transaction_date=datetime(2026, 1, i + 1))
+        for i in range(12)
+    ]
+    db_session.add_all([old, *recent])
+    await db_session.commit()
+
+    with count_queries() as queries:
+        context = await get_agent_context(db_session, user.id, ["cafe"])
+
+    # Transactions, accounts, categories and merchants: one statement each
+    assert queries.count == 4
+    ids = [t["id"] for t in context["recent_transactions"]]
+    # The 10 latest plus the two older Corner Cafe ones
+    assert len(ids) == len(set(ids)) == 12
+    assert {old.id, recent[0].id} <= set(ids)
+
+    context = await get_agent_context(db_session, user.id)
+    assert len(context["recent_transactions"]) == 10
+
+@pytest.mark.asyncio
+async def test_proposal_lookups_reuse_agent_context(db_session):
+    from backend.database import count_queries
+    from backend.services.document_processor import load_proposal_lookups
+
+    user = User(email="lookups@example.com", full_name="Lookups User")
+    db_session.add(user)
+    await db_session.flush()
+    doc = Document(user_id=user.id, original_filename="test.jpg", file_path="/tmp/test.jpg", mime_type="image/jpeg")
+    db_session.add(doc)
+    await db_session.commit()
+
+    context = {"accounts": [{"id": "acc_1", "name": "Petty Cash Account"}], "categories": [{"id": "cat_1", "name": "Food"}]}
+    with count_queries() as queries:
+        lookups = await load_proposal_lookups(db_session, doc, [{"merchant": "Cafe"}], context)
+
+    assert queries.count == 1
+    assert lookups.petty_cash_account_id == "acc_1"
+    assert lookups.category_ids == {"cat_1"}
+
+@pytest.mark.asyncio
+async def test_duplicate_upload_reuses_proposals(db_session):
+    user = User(email="dupe@example.com", full_name="Dupe User")
+    db_session.add(user)
+    await db_session.flush()
+    first = Document(user_id=user.id, original_filename="s.pdf", file_path="/tmp/s.pdf", mime_type="application/pdf",
+                     status="PROCESSED", content_sha256="abc")
+    again = Document(user_id=user.id, original_filename="s.pdf", file_path="/tmp/s2.pdf", mime_type="application/pdf",
+                     status="UPLOADED", content_sha256="abc")
+    db_session.add_all([first, again])
+    await db_session.flush()
+    db_session.add(ProposedChange(user_id=user.id, document_id=first.id, change_type="CREATE_NEW",
+                                  proposed_data={"amount": 7.0}, confidence_score=0.9, status="PENDING"))
+    await db_session.commit()
+
+    with patch("backend.services.document_processor._render_pages") as render, \
+         patch("backend.services.document_processor.SessionLocal") as mock_session_local:
+        mock_session_local.return_value.__aenter__.return_value = db_session
+        await process_document_task(again.id)
+
+    assert not render.called
+    await db_session.refresh(again)
+    assert again.status == "PROCESSED"
+    res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == again.id))
+    [copied] = res.scalars().all()
+    assert copied.status == "PENDING"
+    assert copied.proposed_data == {"amount": 7.0}
+
+@pytest.mark.asyncio
+async def test_duplicate_upload_decided_again_when_proposals_are_stale(db_session):
+    from backend.services.document_processor import copy_duplicate_proposals
+
+    user = User(email="stale_dupe@example.com", full_name="Stale Dupe User")
+    db_session.add(user)
+    await db_session.flush()
+    rejected, deleted_account, again = (
+        Document(user_id=user.id, original_filename="s.pdf", file_path=f"/tmp/s{i}.pdf", mime_type="application/pdf",
+                 status=status, content_sha256=sha)
+        for i, (status, sha) in enumerate([("PROCESSED", "rejected"), ("PROCESSED", "deleted"), ("UPLOADED", None)])
+    )
+    db_session.add_all([rejected, deleted_account, again])
+    await db_session.flush()
+    db_session.add_all([
+        ProposedChange(user_id=user.id, document_id=rejected.id, change_type="CREATE_NEW",
+                       proposed_data={"amount": 7.0}, status="REJECTED"),
+        ProposedChange(user_id=user.id, document_id=deleted_account.id, change_type="CREATE_NEW",
+                       proposed_data={"amount": 7.0, "account_id": "deleted-account"}, status="PENDING"),
+    ])
+    await db_session.commit()
+
+    # A rejected proposal is not brought back, nor one for an account deleted since
+    for sha in ("rejected", "deleted"):
+        again.content_sha256 = sha
+        assert not await copy_duplicate_proposals(db_session, again)
+    res = await db_session.execute(select(ProposedChange).where(ProposedChange.document_id == again.id))
+    assert res.scalars().all() == []
+
+@pytest.mark.asyncio
+async def test_agent_context_is_cached_until_accounts_change(client, db_session, auth_headers):
+    from backend.database import count_queries
+    from backend.services.document_processor import get_agent_context
+
+    await client.get("/accounts/", headers=auth_headers)
+    user = (await db_session.execute(select(User).where(User.email == auth_headers["X-Forwarded-Email"]))).scalar_one()
+
+    first = await get_agent_context(db_session, user.id)
+    with count_queries() as queries:
+        assert await get_agent_context(db_session, user.id) is first
+    assert queries.count == 0
+
+    await client.post("/accounts/", json={"name": "Savings", "type": "ASSET"}, headers=auth_headers)
+    refreshed = await get_agent_context(db_session, user.id)
+    assert "Savings" in {a["name"] for a in refreshed["accounts"]}
+
+    await client.post("/merchants/", json={"name": "Corner Bakery"}, headers=auth_headers)
+    refreshed = await get_agent_context(db_session, user.id)
+    assert "Corner Bakery" in {m["name"] for m in refreshed["merchants"]}
@@ -46,3 +46,28 @@ async def test_delete_document(client: AsyncClient, auth_headers: dict):
     
     list_res = await client.get("/documents/", headers=auth_headers)
     assert all(d["id"] != doc_id for d in list_res.json())
+
+@pytest.mark.asyncio
+async def test_list_documents_cursor_pagination(client: AsyncClient, auth_headers: dict):
+    for name in ("a.txt", "b.txt", "c.txt"):
+        await client.post(
+            "/documents/upload",
+            files={"file": (name, b"data", "text/plain")},
+            headers=auth_headers
+        )
+
+    first = await client.get("/documents/?limit=2", headers=auth_headers)
+    assert first.status_code == 200
+    assert len(first.json()) == 2
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = await client.get(f"/documents/?limit=2&cursor={cursor}", headers=auth_headers)
+    assert second.status_code == 200
+    first_ids = {d["id"] for d in first.json()}
+    assert len(second.json()) >= 1
+    assert not first_ids & {d["id"] for d in second.json()}
+
+@pytest.mark.asyncio
+async def test_list_documents_invalid_cursor(client: AsyncClient, auth_headers: dict):
+    res = await client.get("/documents/?cursor=not-a-cursor", headers=auth_headers)
+    assert res.status_code == 400
@@ -37,6 +37,16 @@ async def test_merchant_crud(client: AsyncClient, auth_headers: dict):
     assert update_res.status_code == 200
     assert update_res.json()["name"] == "Amazon Prime"
     
+    # The name can be left out of an update, but not cleared
+    null_res = await client.patch(f"/merchants/{merchant_id}", json={"name": None}, headers=auth_headers)
+    assert null_res.status_code == 422
+    category_res = await client.patch(f"/merchants/{merchant_id}", json={"default_category_id": None}, headers=auth_headers)
+    assert category_res.json()["name"] == "Amazon Prime"
+
+    # Search is case-insensitive and follows the renamed value
+    search_res = await client.get("/merchants/?q=aMaZoN pr", headers=auth_headers)
+    assert [m["id"] for m in search_res.json()] == [merchant_id]
+    
     # 5. Delete Merchant
     del_res = await client.delete(f"/merchants/{merchant_id}", headers=auth_headers)
     assert del_res.status_code == 204
@@ -255,6 +255,53 @@ async def test_proposal_create_batch(client: AsyncClient, db_session, auth_heade
     assert any(t.amount == 100.0 for t in transactions)
     assert any(t.amount == 200.0 for t in transactions)
 
+    # Both transactions are linked to the source document
+    from backend.models import transaction_document
+    links = (await db_session.execute(
+        select(transaction_document.c.transaction_id).where(transaction_document.c.document_id == doc.id)
+    )).scalars().all()
+    assert set(links) == {t.id for t in transactions}
+
+    from backend.database import count_queries
+    with count_queries() as queries:
+        docs_res = await client.get(f"/transactions/{transactions[0].id}/documents", headers=auth_headers)
+    assert docs_res.status_code == 200
+    assert queries.count == 1
+    assert [d["id"] for d in docs_res.json()] == [doc.id]
+
+@pytest.mark.asyncio
+async def test_proposal_create_batch_updates_transfer_targets(client: AsyncClient, db_session, auth_headers: dict, sample_account):
+    await client.get("/accounts/", headers=auth_headers)
+    from backend.models import User, Document, Account
+    user = (await db_session.execute(select(User).where(User.email == "test@example.com"))).scalars().first()
+
+    doc = Document(user_id=user.id, original_filename="transfers.pdf", file_path="/tmp/transfers.pdf", mime_type="application/pdf")
+    db_session.add(doc)
+    await db_session.flush()
+
+    proposal = ProposedChange(
+        user_id=user.id, document_id=doc.id, change_type="CREATE_ACCOUNT",
+        proposed_data={
+            "_new_account": {"name": "Wallet", "type": "ASSET"},
+            "opening_balance": 500.0,
+            "transactions": [
+                {"amount": 50.0, "type": "TRANSFER", "target_account_id": sample_account, "transaction_date": "2026-01-01"},
+                {"amount": 70.0, "type": "TRANSFER", "target_account_id": sample_account, "transaction_date": "2026-01-02"}
+            ]
+        },
+        status="PENDING"
+    )
+    db_session.add(proposal)
+    await db_session.commit()
+
+    res = await client.post(f"/proposals/{proposal.id}/confirm", json={"status": "APPROVED"}, headers=auth_headers)
+    assert res.status_code == 200
+
+    wallet = (await db_session.execute(select(Account).where(Account.name == "Wallet"))).scalars().first()
+    bank = await db_session.get(Account, sample_account)
+    assert wallet.current_balance == 380.0
+    assert bank.current_balance == 120.0
+
 @pytest.mark.asyncio
 async def test_proposal_create_account_override(client: AsyncClient, db_session, auth_headers: dict, sample_account):
     # Setup
@@ -303,3 +350,29 @@ async def test_proposal_create_account_override(client: AsyncClient, db_session,
 async def test_proposal_not_found(client: AsyncClient, auth_headers: dict):
     res = await client.post("/proposals/non-existent-id/confirm", json={"status": "APPROVED"}, headers=auth_headers)
     assert res.status_code == 404
+
+@pytest.mark.asyncio
+async def test_list_proposals_cursor_pagination(client: AsyncClient, db_session, auth_headers: dict):
+    await client.get("/accounts/", headers=auth_headers)
+    from backend.models import User
+    user = (await db_session.execute(select(User).where(User.email == "test@example.com"))).scalars().first()
+
+    doc = Document(user_id=user.id, original_filename="page.pdf", file_path="/tmp/page.pdf", mime_type="application/pdf")
+    db_session.add(doc)
+    await db_session.flush()
+    for i in range(3):
+        db_session.add(ProposedChange(
+            user_id=user.id, document_id=doc.id, change_type="CREATE_NEW",
+            proposed_data={"amount": float(i)}, status="PENDING"
+        ))
+    await db_session.commit()
+
+    first = await client.get("/proposals/?limit=2", headers=auth_headers)
+    assert len(first.json()) == 2
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = await client.get(f"/proposals/?limit=2&cursor={cursor}", headers=auth_headers)
+    assert len(second.json()) == 1
+    assert "X-Next-Cursor" not in second.headers
+    ids = [p["id"] for p in first.json() + second.json()]
+    assert len(set(ids)) == 3
@@ -0,0 +1,35 @@
+import pytest
+from httpx import AsyncClient
+from backend.database import count_queries
+from backend.config import settings
+
+LIST_ENDPOINTS = ["/accounts/", "/categories/", "/merchants/", "/documents/", "/transactions/", "/proposals/"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", LIST_ENDPOINTS)
+async def test_list_endpoints_issue_at_most_two_queries(client: AsyncClient, auth_headers: dict, path: str):
+    # Register the user and give the lists some rows
+    for i in range(5):
+        await client.post("/merchants/", json={"name": f"Shop {i}"}, headers=auth_headers)
+        await client.post("/accounts/", json={"name": f"Account {i}", "type": "ASSET"}, headers=auth_headers)
+
+    with count_queries() as queries:
+        response = await client.get(path, headers=auth_headers)
+
+    assert response.status_code == 200
+    assert 1 <= queries.count <= 2
+
+@pytest.mark.asyncio
+async def test_health_db_hides_pool_status(client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(settings, "DEV_MODE", False)
+    response = await client.get("/health/db")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+    monkeypatch.setattr(settings, "DEV_MODE", True)
+    assert "pool" in (await client.get("/health/db")).json()
+
+@pytest.mark.asyncio
+async def test_missing_asset_is_not_found(client: AsyncClient):
+    response = await client.get("/assets/index-abc123.js")
+    assert response.status_code == 404
@@ -16,3 +16,44 @@ async def test_wealth_chart(client: AsyncClient, auth_headers: dict, sample_acco
     assert "data_points" in data
     assert len(data["data_points"]) > 0
     assert data["data_points"][0]["assets"] == 5000.0
+
+@pytest.mark.asyncio
+async def test_wealth_chart_rolls_back_by_period(client: AsyncClient, auth_headers: dict, sample_account):
+    card = (await client.post("/accounts/", json={"name": "Card", "type": "LIABILITY"}, headers=auth_headers)).json()["id"]
+    for tx in [
+        {"account_id": sample_account, "amount": 1000.0, "type": "INCOME", "transaction_date": "2024-01-05T10:00:00"},
+        {"account_id": card, "amount": 500.0, "type": "EXPENSE", "transaction_date": "2024-01-20T10:00:00"},
+        {"account_id": sample_account, "amount": 200.0, "type": "EXPENSE", "transaction_date": "2024-02-10T10:00:00"},
+        {"account_id": sample_account, "target_account_id": card, "amount": 300.0, "type": "TRANSFER", "transaction_date": "2024-03-15T10:00:00"},
+    ]:
+        assert (await client.post("/transactions/", json=tx, headers=auth_headers)).status_code == 200
+
+    response = await client.get("/wealth/chart", headers=auth_headers)
+    assert response.status_code == 200
+    points = [(p["date"], p["assets"], p["liabilities"], p["net_worth"]) for p in response.json()["data_points"]]
+    assert points[:3] == [
+        ("2024-01-31", 1000.0, 500.0, 500.0),
+        ("2024-02-29", 800.0, 500.0, 300.0),
+        ("2024-03-31", 500.0, 200.0, 300.0),
+    ]
+    # Current period reflects the live balances
+    assert points[-1][1:] == (500.0, 200.0, 300.0)
+
+    days = (await client.get("/wealth/chart?interval=day", headers=auth_headers)).json()["data_points"]
+    assert (days[0]["date"], days[0]["net_worth"]) == ("2024-01-05", 1000.0)
+    years = (await client.get("/wealth/chart?interval=year", headers=auth_headers)).json()["data_points"]
+    assert (years[0]["date"], years[0]["net_worth"]) == ("2024", 300.0)
+
+@pytest.mark.asyncio
+async def test_wealth_chart_limits_months(client: AsyncClient, auth_headers: dict, sample_account):
+    for i in range(14):
+        year, month = 2023 + i // 12, i % 12 + 1
+        tx = {"account_id": sample_account, "amount": 100.0, "type": "INCOME", "transaction_date": f"{year}-{month:02d}-10T10:00:00"}
+        assert (await client.post("/transactions/", json=tx, headers=auth_headers)).status_code == 200
+
+    response = await client.get("/wealth/chart", headers=auth_headers)
+    points = response.json()["data_points"]
+    # Current month plus the 11 most recent months with activity
+    assert len(points) == 12
+    assert (points[0]["date"], points[0]["net_worth"]) == ("2023-04-30", 400.0)
+    assert (points[-2]["date"], points[-2]["net_worth"]) == ("2024-02-29", 1400.0)
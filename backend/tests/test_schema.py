@@ -0,0 +1,37 @@
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+from backend.database import Base
+
+def test_timestamp_defaults_compile_for_postgresql():
+    dialect = postgresql.dialect()
+    ddl = "\n".join(str(CreateTable(table).compile(dialect=dialect)) for table in Base.metadata.sorted_tables)
+
+    assert "strftime" not in ddl
+    assert "created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT timezone('utc', now())" in ddl
+
+def test_upgrade_dedupes_only_pending_proposals(tmp_path, capsys):
+    from sqlalchemy import create_engine, select, text
+    from sqlalchemy.orm import Session
+    from backend.database import _upgrade_existing_tables
+    from backend.models import ProposedChange
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        # A release without the unique index, holding duplicates of every status
+        conn.execute(text("DROP INDEX ux_proposed_change_document_target_pending"))
+    with Session(engine) as session:
+        session.add_all([
+            ProposedChange(user_id="u", document_id="d", target_transaction_id="t", change_type="UPDATE_EXISTING", status=status, proposed_data={"n": i})
+            for i, status in enumerate(["APPROVED", "PENDING", "REJECTED", "PENDING", "PENDING"])
+        ])
+        session.commit()
+
+    with engine.begin() as conn:
+        _upgrade_existing_tables(conn)
+    with Session(engine) as session:
+        kept = session.execute(select(ProposedChange.status, ProposedChange.proposed_data)).all()
+    engine.dispose()
+
+    assert sorted((status, data["n"]) for status, data in kept) == [("APPROVED", 0), ("PENDING", 4), ("REJECTED", 2)]
+    assert "deleted 2 duplicate rows from proposed_change" in capsys.readouterr().out
@@ -45,6 +45,42 @@ async def test_list_transactions_pagination(client: AsyncClient, auth_headers: d
     # Skip 3 should leave at least 2 from this test.
     assert len(response.json()) >= 2
 
+@pytest.mark.asyncio
+async def test_list_transactions_cursor_pagination(client: AsyncClient, auth_headers: dict, sample_account):
+    for day in range(1, 6):
+        await client.post(
+            "/transactions/",
+            json={"account_id": sample_account, "amount": 1.0, "type": "EXPENSE", "transaction_date": f"2025-03-0{day}T12:00:00"},
+            headers=auth_headers
+        )
+
+    dates, cursor = [], None
+    while True:
+        url = "/transactions/?limit=2" + (f"&cursor={cursor}" if cursor else "")
+        response = await client.get(url, headers=auth_headers)
+        assert response.status_code == 200
+        dates += [t["transaction_date"][:10] for t in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert dates == [f"2025-03-0{day}" for day in range(5, 0, -1)]
+
+@pytest.mark.asyncio
+async def test_list_transactions_page_size_is_capped(client: AsyncClient, auth_headers: dict, sample_account, monkeypatch):
+    monkeypatch.setattr("backend.dependencies.MAX_PAGE_SIZE", 2)
+    for day in range(1, 4):
+        await client.post(
+            "/transactions/",
+            json={"account_id": sample_account, "amount": 1.0, "type": "EXPENSE", "transaction_date": f"2025-04-0{day}T12:00:00"},
+            headers=auth_headers
+        )
+
+    response = await client.get("/transactions/?limit=1000", headers=auth_headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+    assert response.headers.get("X-Next-Cursor")
+
 @pytest.mark.asyncio
 async def test_list_transactions_search(client: AsyncClient, auth_headers: dict, sample_account):
     await client.post(
@@ -126,3 +162,48 @@ async def test_delete_transaction_not_found(client: AsyncClient, auth_headers: d
 async def test_get_transaction_documents_not_found(client: AsyncClient, auth_headers: dict):
     res = await client.get("/transactions/non-existent/documents", headers=auth_headers)
     assert res.status_code == 404
+
+@pytest.mark.asyncio
+async def test_delete_transaction_removes_document_links(client: AsyncClient, db_session, auth_headers: dict, sample_account):
+    from sqlalchemy import select
+    from backend.models import Document, User, transaction_document
+
+    tx = (await client.post(
+        "/transactions/",
+        json={"account_id": sample_account, "amount": 7.0, "type": "EXPENSE", "transaction_date": "2025-05-01T12:00:00"},
+        headers=auth_headers
+    )).json()
+    user = (await db_session.execute(select(User).where(User.email == "test@example.com"))).scalars().first()
+    doc = Document(user_id=user.id, original_filename="r.pdf", file_path="/tmp/r.pdf", mime_type="application/pdf")
+    db_session.add(doc)
+    await db_session.flush()
+    await db_session.execute(transaction_document.insert().values(transaction_id=tx["id"], document_id=doc.id))
+    await db_session.commit()
+
+    res = await client.delete(f"/transactions/{tx['id']}", headers=auth_headers)
+    assert res.status_code == 204
+
+    links = (await db_session.execute(
+        select(transaction_document.c.document_id).where(transaction_document.c.transaction_id == tx["id"])
+    )).all()
+    assert links == []
+    assert (await client.delete(f"/transactions/{tx['id']}", headers=auth_headers)).status_code == 404
+
+@pytest.mark.asyncio
+async def test_export_transactions_ndjson(client: AsyncClient, auth_headers: dict, sample_account, monkeypatch):
+    import json
+    monkeypatch.setattr("backend.routers.transactions.EXPORT_BATCH_SIZE", 2)
+    for day in range(1, 6):
+        await client.post(
+            "/transactions/",
+            json={"account_id": sample_account, "amount": float(day), "type": "EXPENSE", "transaction_date": f"2025-06-0{day}T12:00:00"},
+            headers=auth_headers
+        )
+
+    response = await client.get("/transactions/export", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    exported = [r["transaction_date"][:10] for r in rows if r["transaction_date"].startswith("2025-06")]
+    assert exported == [f"2025-06-0{day}" for day in range(5, 0, -1)]
+    assert all("note" not in r for r in rows if r["transaction_date"].startswith("2025-06"))